@@ -0,0 +1,191 @@
+"""
+CPU-optimized inference backends for the Detector.
+
+The PyTorch weights (best.pt / yolov8n.pt) are exported once to ONNX Runtime or
+OpenVINO IR (the latter optionally INT8-quantized with calibration images from
+yolo_dataset/val through data.yaml), and cached in model_cache/. The cache key
+contains the content hash of the weights, so a retrained best.pt is re-exported
+automatically. Exported models are loaded back through YOLO(), so predict/track
+and the Detector post-processing stay exactly the same.
+
+    python backends.py --compare --backends pytorch onnx openvino --int8
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import cv2
+import numpy as np
+from store import file_hash
+from train import TRAIN_IMGSZ
+
+BACKENDS = ('pytorch', 'onnx', 'openvino')
+INT8_BACKENDS = ('openvino',)  # ultralytics ignores int8 for ONNX exports
+CACHE_DIR = 'model_cache'
+
+
+def _cache_name(weights, backend, int8, imgsz):
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    return f"{stem}-{backend}{'-int8' if int8 else ''}-{imgsz}"
+
+
+def _export(weights, backend, int8, imgsz, data):
+    from ultralytics import YOLO
+    model = YOLO(weights)
+    if int8:
+        # Calibrated with NNCF on the val images listed in data.yaml
+        return model.export(format=backend, imgsz=imgsz, int8=True, data=data)
+    return model.export(format=backend, imgsz=imgsz)
+
+
+def _check_int8(backend, int8):
+    if int8 and backend not in INT8_BACKENDS:
+        raise ValueError(f"INT8 is only supported for {', '.join(INT8_BACKENDS)}, not '{backend}'")
+
+
+def export_model(weights, backend='onnx', int8=False, imgsz=TRAIN_IMGSZ, cache_dir=CACHE_DIR, data='data.yaml'):
+    """Returns the path of the cached export, exporting (again) if the weights changed."""
+    _check_int8(backend, int8)
+    digest = file_hash(weights)[:12]
+    prefix = _cache_name(weights, backend, int8, imgsz)
+    target_dir = os.path.join(cache_dir, f'{prefix}-{digest}')
+    info_path = os.path.join(target_dir, 'export.json')
+
+    if os.path.exists(info_path):
+        with open(info_path, 'r') as f:
+            exported = os.path.join(target_dir, json.load(f)['path'])
+        if os.path.exists(exported):
+            return exported
+
+    # Exports for older versions of the same weights are stale now
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix + '-') and name != os.path.basename(target_dir):
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    print(f"Exporting {weights} to {backend}{' (INT8)' if int8 else ''}, this only happens once per model...")
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.makedirs(target_dir)
+    # Export next to a private copy so the artifacts land in the cache folder
+    local_weights = os.path.join(target_dir, os.path.basename(weights))
+    shutil.copy(weights, local_weights)
+    exported = str(_export(local_weights, backend, int8, imgsz, data))
+    os.remove(local_weights)
+
+    with open(info_path, 'w') as f:
+        json.dump({'path': os.path.relpath(exported, target_dir), 'weights': weights, 'hash': digest,
+                   'backend': backend, 'int8': int8, 'imgsz': imgsz}, f, indent=4)
+    return exported
+
+
+def load_model(weights, backend='pytorch', int8=False, imgsz=TRAIN_IMGSZ, cache_dir=CACHE_DIR, data='data.yaml'):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    _check_int8(backend, int8)
+    # Imported here so importing this module (and utils) stays cheap
+    from ultralytics import YOLO
+    if backend == 'pytorch':
+        return YOLO(weights)
+    return YOLO(export_model(weights, backend, int8, imgsz, cache_dir, data), task='detect')
+
+
+# --- Latency / accuracy comparison -------------------------------------------
+
+def _iou(a, b):
+    # Pairwise IoU between (N, 4) and (M, 4) xyxy boxes
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def _agreement(reference, preds, iou_thres=0.5):
+    """Share of reference boxes found again (same class, IoU >= iou_thres) and of extra boxes."""
+    matched = total_ref = total_pred = 0
+    for (ref_xyxy, ref_cls), (xyxy, cls) in zip(reference, preds):
+        total_ref += len(ref_cls)
+        total_pred += len(cls)
+        if len(ref_cls) and len(cls):
+            ok = (_iou(ref_xyxy, xyxy) >= iou_thres) & (ref_cls[:, None] == cls[None, :])
+            matched += int(ok.any(axis=1).sum())
+    return {
+        'recall_vs_pytorch': round(matched / total_ref, 4) if total_ref else None,
+        'extra_boxes': total_pred - matched
+    }
+
+
+def compare_backends(weights='best.pt', backends=BACKENDS, int8=False, images_dir='yolo_dataset/val/images',
+                     limit=100, imgsz=TRAIN_IMGSZ, val=False):
+    names = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(('.jpg', '.png', '.jpeg')))[:limit]
+    frames = [cv2.imread(os.path.join(images_dir, n)) for n in names]
+    if not frames:
+        raise SystemExit(f"No images found in {images_dir}")
+
+    # PyTorch FP32 is always the reference
+    backends = ['pytorch'] + [b for b in backends if b != 'pytorch']
+    reference = None
+    report = []
+    for backend in backends:
+        use_int8 = int8 and backend in INT8_BACKENDS
+        model = load_model(weights, backend, use_int8, imgsz)
+        model.predict(frames[0], imgsz=imgsz, verbose=False)  # warmup
+
+        latencies, preds = [], []
+        for frame in frames:
+            t0 = time.perf_counter()
+            r = model.predict(frame, imgsz=imgsz, conf=0.25, iou=0.5, agnostic_nms=True, verbose=False)[0]
+            latencies.append((time.perf_counter() - t0) * 1000)
+            preds.append((r.boxes.xyxy.cpu().numpy(), r.boxes.cls.cpu().numpy()))
+
+        row = {
+            'backend': backend,
+            'int8': use_int8,
+            'mean_ms': round(float(np.mean(latencies)), 2),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+            'fps': round(1000 / float(np.mean(latencies)), 1)
+        }
+        if reference is None:
+            reference = preds
+        else:
+            row.update(_agreement(reference, preds))
+        if val:
+            metrics = model.val(data='data.yaml', imgsz=imgsz, verbose=False)
+            row['map50'] = round(float(metrics.box.map50), 4)
+            row['map50_95'] = round(float(metrics.box.map), 4)
+        print(row)
+        report.append(row)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export / compare CPU inference backends")
+    parser.add_argument('--weights', default='best.pt' if os.path.exists('best.pt') else 'yolov8n.pt')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--int8', action='store_true',
+                        help="INT8 quantization calibrated on yolo_dataset/val (OpenVINO only)")
+    parser.add_argument('--imgsz', type=int, default=TRAIN_IMGSZ)
+    parser.add_argument('--compare', action='store_true', help="Measure latency and agreement with PyTorch")
+    parser.add_argument('--val', action='store_true', help="Also run model.val() on data.yaml for mAP")
+    parser.add_argument('--images', default='yolo_dataset/val/images')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--output', default='backend_comparison.json')
+    args = parser.parse_args()
+
+    if not args.compare:
+        for backend in args.backends:
+            if backend != 'pytorch':
+                print(export_model(args.weights, backend, args.int8 and backend in INT8_BACKENDS, args.imgsz))
+        return
+
+    report = compare_backends(args.weights, args.backends, args.int8, args.images, args.limit, args.imgsz, args.val)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Comparison written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Headless batch processor: runs the Detector over recorded footage without any window.
+
+Sources can be video files, stream URLs (rtsp://, http://) or image folders.
+They are cut into chunks of consecutive frames and sharded over a process pool
+(one model per worker). Workers decode their own frames: a chunk is only a file
+list or a frame range, so no raw frames are pickled between processes. Live
+streams can't be seeked or reopened, those are still read in the main process.
+Results are written back in the original order to a JSONL or CSV file, with
+throughput stats next to it. Each chunk is tracked on its own, so
+`chunk_track_id` only identifies an object within its (source, chunk).
+
+    python batch_process.py footage/line1.mp4 captures/ -o results.jsonl --workers 4
+"""
+import argparse
+import collections
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+
+IMAGE_EXTS = ('.jpg', '.png', '.jpeg')
+
+FIELDS = ['source', 'frame', 'ref', 'chunk', 'chunk_track_id', 'class', 'conf',
+          'x1', 'y1', 'x2', 'y2', 'is_fruit', 'ripeness', 'nutrition_key']
+
+
+def _is_stream(source):
+    return '://' in source
+
+
+def iter_stream(source):
+    """Yields (frame_index, ref, frame) from a video file or stream URL."""
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        print(f"Could not open source: {source}")
+        return
+    i = 0
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield i, i, frame
+            i += 1
+    finally:
+        cap.release()
+
+
+def iter_chunks(sources, chunk_size):
+    """
+    Yields (source, chunk_no, kind, payload) tasks; consecutive frames stay
+    together so tracking works inside a chunk.
+      'files'  payload = [(frame_index, file name)]  (image folders)
+      'range'  payload = (start, stop)               (seekable video files)
+      'frames' payload = [(frame_index, ref, frame)] (streams, decoded here)
+    """
+    chunk_no = 0
+    for source in sources:
+        if os.path.isdir(source):
+            names = sorted(f for f in os.listdir(source) if f.lower().endswith(IMAGE_EXTS))
+            for start in range(0, len(names), chunk_size):
+                yield source, chunk_no, 'files', [(i, names[i]) for i in range(start, min(start + chunk_size, len(names)))]
+                chunk_no += 1
+            continue
+
+        total = 0
+        if not _is_stream(source):
+            cap = cv2.VideoCapture(source)
+            if not cap.isOpened():
+                print(f"Could not open source: {source}")
+                continue
+            total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+        if total > 0:
+            for start in range(0, total, chunk_size):
+                yield source, chunk_no, 'range', (start, min(start + chunk_size, total))
+                chunk_no += 1
+            continue
+
+        # Streams (or files without a frame count) can only be read front to back
+        chunk = []
+        for item in iter_stream(source):
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield source, chunk_no, 'frames', chunk
+                chunk_no += 1
+                chunk = []
+        if chunk:
+            yield source, chunk_no, 'frames', chunk
+            chunk_no += 1
+
+
+# --- Worker side -----------------------------------------------------------
+
+_detector = None
+_capture = None  # (source, VideoCapture, next frame index), reused when the next chunk follows on
+
+
+def init_worker(threads=1):
+    # One model per worker process, with a small thread budget so workers don't fight
+    global _detector
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from utils import Detector
+    _detector = Detector()
+
+
+def load_frames(source, kind, payload):
+    """Yields (frame_index, ref, frame) for one task, decoded in the worker."""
+    global _capture
+    if kind == 'frames':
+        yield from payload
+    elif kind == 'files':
+        for i, name in payload:
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is not None:
+                yield i, name, frame
+    else:
+        start, stop = payload
+        if _capture is None or _capture[0] != source or _capture[2] != start:
+            if _capture is not None:
+                _capture[1].release()
+            cap = cv2.VideoCapture(source)
+            if start:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, start)  # Seeks to the keyframe before and decodes forward
+            _capture = (source, cap, start)
+        cap = _capture[1]
+        for i in range(start, stop):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            _capture = (source, cap, i + 1)
+            yield i, i, frame
+
+
+def process_chunk(task, include_all=False):
+    source, chunk_no, kind, payload = task
+    stream = f"{source}#{chunk_no}"
+    rows = []
+    n_frames = 0
+    start = time.perf_counter()
+    for frame_idx, ref, frame in load_frames(source, kind, payload):
+        n_frames += 1
+        detections = _detector.detect_and_track_streams({stream: frame})[stream]
+        if not include_all:
+            detections = detections.fruits()
+        ripeness = _detector.get_ripeness_batch(frame, detections)
+        for d, ripe in zip(detections, ripeness):
+            x1, y1, x2, y2 = d['bbox']
+            # The catalog entry the name really resolved to (plural, synonym or typo of it)
+            nutrition_key = _detector.nutrition.resolve(d['name'])
+            rows.append({
+                'source': source, 'frame': frame_idx, 'ref': ref, 'chunk': chunk_no,
+                'chunk_track_id': d['id'], 'class': d['name'], 'conf': round(d['conf'], 4),
+                'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2,
+                'is_fruit': d['is_fruit'], 'ripeness': ripe, 'nutrition_key': nutrition_key
+            })
+    # Track ids are only meaningful inside a chunk, drop the tracker with it
+    _detector.reset_stream(stream)
+    return rows, n_frames, time.perf_counter() - start
+
+
+# --- Output ------------------------------------------------------------------
+
+class ResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'w', newline='')
+        self.csv = None
+        if path.lower().endswith('.csv'):
+            self.csv = csv.DictWriter(self.f, fieldnames=FIELDS)
+            self.csv.writeheader()
+
+    def write(self, rows):
+        if self.csv:
+            self.csv.writerows(rows)
+        else:
+            for row in rows:
+                self.f.write(json.dumps(row) + '\n')
+
+    def close(self):
+        self.f.close()
+
+
+def run(sources, output, workers=os.cpu_count() or 1, chunk_size=64, threads=1, include_all=False):
+    writer = ResultWriter(output)
+    stats = {'frames': 0, 'detections': 0, 'chunks': 0, 'worker_seconds': 0.0}
+    start = time.perf_counter()
+
+    def collect(result):
+        rows, n_frames, seconds = result
+        writer.write(rows)
+        stats['frames'] += n_frames
+        stats['detections'] += len(rows)
+        stats['chunks'] += 1
+        stats['worker_seconds'] += seconds
+        if stats['chunks'] % 10 == 0:
+            elapsed = time.perf_counter() - start
+            print(f"{stats['frames']} frames, {stats['frames'] / elapsed:.1f} fps")
+
+    try:
+        if workers <= 1:
+            init_worker(threads)
+            for task in iter_chunks(sources, chunk_size):
+                collect(process_chunk(task, include_all))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads,)) as pool:
+                # Bounded number of chunks in flight, results collected in submission order
+                pending = collections.deque()
+                for task in iter_chunks(sources, chunk_size):
+                    pending.append(pool.submit(process_chunk, task, include_all))
+                    if len(pending) >= workers * 2:
+                        collect(pending.popleft().result())
+                while pending:
+                    collect(pending.popleft().result())
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    stats.update({
+        'sources': list(sources),
+        'output': output,
+        'workers': workers,
+        'chunk_size': chunk_size,
+        'elapsed_seconds': round(elapsed, 3),
+        'fps': round(stats['frames'] / elapsed, 2) if elapsed > 0 else 0.0,
+        'worker_seconds': round(stats['worker_seconds'], 3)
+    })
+    with open(os.path.splitext(output)[0] + '.stats.json', 'w') as f:
+        json.dump(stats, f, indent=4)
+    print(f"Done: {stats['frames']} frames, {stats['detections']} detections "
+          f"in {stats['elapsed_seconds']}s ({stats['fps']} fps)")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline fruit detection over videos, streams and image folders")
+    parser.add_argument('sources', nargs='+', help="Video files, stream URLs or image folders")
+    parser.add_argument('-o', '--output', default='results.jsonl', help="Output file (.jsonl or .csv)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Worker processes (1 = in-process)")
+    parser.add_argument('--chunk-size', type=int, default=64, help="Consecutive frames per task")
+    parser.add_argument('--threads', type=int, default=1, help="Inference threads per worker")
+    parser.add_argument('--all', action='store_true', help="Also write non-fruit detections")
+    args = parser.parse_args()
+    run(args.sources, args.output, args.workers, args.chunk_size, args.threads, args.all)
+
+
+if __name__ == "__main__":
+    main()
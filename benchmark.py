@@ -0,0 +1,320 @@
+"""
+Reproducible performance benchmarks for the detection and data paths.
+
+Needs no camera and no network: frames are synthetic (fixed seed) or read from a
+recorded clip, and the YOLO model is replaced by a stub by default so the numbers
+measure OUR code. Use --model to benchmark real weights instead.
+
+    python benchmark.py                          # write bench_results/<commit>.json
+    python benchmark.py --clip line1.mp4 --compare bench_results/abc123.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STUB_NAMES = {0: 'apple', 1: 'banana', 2: 'orange', 3: 'person'}
+
+
+class StubBoxes:
+    """Mimics ultralytics Boxes with plain NumPy arrays."""
+    def __init__(self, xyxy, cls, conf, ids):
+        self.xyxy = xyxy
+        self.cls = cls
+        self.conf = conf
+        self.id = ids
+
+    def __len__(self):
+        return len(self.cls)
+
+
+class StubResult:
+    def __init__(self, boxes, orig_img):
+        self.boxes = boxes
+        self.orig_img = orig_img
+
+
+class StubModel:
+    """
+    Drop-in for YOLO in benchmarks: returns `n_boxes` deterministic boxes per
+    frame, optionally sleeping `delay_ms` to simulate inference cost.
+    """
+    def __init__(self, n_boxes=5, delay_ms=0.0, names=STUB_NAMES, seed=0):
+        self.names = names
+        self.n_boxes = n_boxes
+        self.delay = delay_ms / 1000.0
+        self.rng = np.random.default_rng(seed)
+
+    def _result(self, frame):
+        h, w = frame.shape[:2]
+        x1 = self.rng.integers(0, w // 2, self.n_boxes)
+        y1 = self.rng.integers(0, h // 2, self.n_boxes)
+        bw = self.rng.integers(20, w // 2, self.n_boxes)
+        bh = self.rng.integers(20, h // 2, self.n_boxes)
+        xyxy = np.stack([x1, y1, x1 + bw, y1 + bh], axis=1).astype(np.float32)
+        cls = (np.arange(self.n_boxes) % len(self.names)).astype(np.float32)
+        conf = self.rng.uniform(0.25, 1.0, self.n_boxes).astype(np.float32)
+        ids = np.arange(1, self.n_boxes + 1, dtype=np.float32)
+        return StubResult(StubBoxes(xyxy, cls, conf, ids), frame)
+
+    def track(self, frame, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        return [self._result(frame)]
+
+    def predict(self, frames, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        frames = frames if isinstance(frames, list) else [frames]
+        return [self._result(f) for f in frames]
+
+
+def synthetic_frames(n=60, width=640, height=480, seed=0):
+    # Noisy background with a few coloured "fruits", same output for the same seed
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(n):
+        frame = rng.integers(0, 60, (height, width, 3), dtype=np.uint8)
+        for _ in range(5):
+            center = (int(rng.integers(40, width - 40)), int(rng.integers(40, height - 40)))
+            axes = (int(rng.integers(15, 60)), int(rng.integers(15, 60)))
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            cv2.ellipse(frame, center, axes, 0, 0, 360, color, -1)
+        frames.append(frame)
+    return frames
+
+
+def clip_frames(path, limit=300):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < limit:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise SystemExit(f"Could not read any frame from {path}")
+    return frames
+
+
+def peak_rss_mb():
+    if resource is None:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2 ** 20
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def measure(fn, items, warmup=3):
+    """Calls fn(item) for every item, returns fps and latency percentiles."""
+    for item in items[:warmup]:
+        fn(item)
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - t0)
+    total = time.perf_counter() - start
+    ms = np.array(latencies) * 1000.0
+    return {
+        'iterations': len(items),
+        'fps': round(len(items) / total, 2) if total > 0 else None,
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+# --- Benchmarks ----------------------------------------------------------------
+# Each one gets (detector, frames) and returns the `measure` dict.
+
+def bench_detect_and_track(detector, frames):
+    return measure(detector.detect_and_track, frames)
+
+
+def bench_ripeness_color(detector, frames):
+    # Per-crop API, one call per detection like the old code paths
+    def score(frame):
+        for d in detector.detect_and_track(frame).fruits():
+            x1, y1, x2, y2 = d['bbox']
+            detector.get_ripeness_color(frame[y1:y2, x1:x2], d['name'])
+    return measure(score, frames)
+
+
+def bench_ripeness_batch(detector, frames):
+    detections = [detector.detect_and_track(f).fruits() for f in frames]
+    return measure(lambda i: detector.get_ripeness_batch(frames[i], detections[i]), list(range(len(frames))))
+
+
+def bench_save_fruit_data(detector, frames):
+    # The GUI save path including the few-shot enrolment, done synchronously so it is timed and
+    # finished before the next benchmark (histogram embedder: no torch, same on every machine)
+    from fewshot import FewShotRegistry, HistogramEmbedder
+    crops = [f[100:300, 100:300] for f in frames[:20]]
+    registry, detector.registry = detector.registry, FewShotRegistry(embedder=HistogramEmbedder())
+    try:
+        return measure(lambda i: detector.save_fruit_data(f"bench_fruit_{i % 3}", "Ripe", crops, block=True),
+                       list(range(10)), warmup=1)
+    finally:
+        detector.registry = registry
+
+
+def bench_prepare_dataset(detector, frames):
+    import train
+    for cls in ('apple', 'banana', 'orange'):
+        os.makedirs(f'data/{cls}', exist_ok=True)
+        for i, frame in enumerate(frames[:40]):
+            cv2.imwrite(f'data/{cls}/sample_{i}.jpg', frame[:200, :200])
+    return measure(lambda _: train.prepare_yolo_dataset(), list(range(5)), warmup=1)
+
+
+def bench_render(detector, frames):
+    # The GUI render path: downscale to the video area, draw the boxes, paste into the reused PhotoImage
+    from PIL import Image
+    from render import FrameRenderer
+    try:
+        import tkinter
+        root = tkinter.Tk()
+        root.withdraw()
+        label = tkinter.Label(root)
+    except Exception:
+        root = label = None  # headless box, measure everything but the PhotoImage
+
+    class HeadlessRenderer(FrameRenderer):
+        def _new_photo(self, w, h):
+            return Image.new('RGB', (w, h))  # Same paste() as the Tk image
+
+    # Video area of main.py's default 1000x600 window, no refresh-rate cap so every frame is drawn
+    renderer = (FrameRenderer if root is not None else HeadlessRenderer)(
+        label, size_fn=lambda: (700, 520), max_fps=1e9)
+    boxes = [((40, 60, 240, 260), 'apple (Ripe)', (0, 255, 0)), ((300, 120, 420, 300), 'banana', (0, 255, 0))]
+
+    try:
+        result = measure(lambda frame: renderer.render(frame, boxes), frames)
+        result['photoimage'] = root is not None
+        return result
+    finally:
+        if root is not None:
+            root.destroy()
+
+
+BENCHMARKS = {
+    'detect_and_track': bench_detect_and_track,
+    'get_ripeness_color': bench_ripeness_color,
+    'get_ripeness_batch': bench_ripeness_batch,
+    'save_fruit_data': bench_save_fruit_data,
+    'prepare_yolo_dataset': bench_prepare_dataset,
+    'render': bench_render,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+    print(f"\nCompared to {baseline_path}:")
+    for name, res in results.items():
+        old = baseline.get(name)
+        if not old or 'error' in res or 'error' in old:
+            continue
+        for key in ('fps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if old.get(key) and res.get(key) is not None:
+                change = (res[key] - old[key]) / old[key] * 100
+                print(f"  {name:22s} {key:7s} {old[key]:>10} -> {res[key]:>10} ({change:+.1f}%)")
+
+
+def run(args):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    from utils import Detector
+
+    frames = clip_frames(args.clip) if args.clip else synthetic_frames(args.frames)
+    selected = args.only or list(BENCHMARKS)
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='fruit_bench_')
+    cwd = os.getcwd()
+    try:
+        # Data benchmarks write database.json, data/ and yolo_dataset/, keep them out of the repo
+        os.chdir(work_dir)
+        if args.model:
+            detector = Detector(model_path=os.path.join(cwd, args.model))
+        else:
+            detector = Detector(model=StubModel(n_boxes=args.boxes, delay_ms=args.delay_ms))
+        for name in selected:
+            print(f"Running {name}...")
+            try:
+                results[name] = BENCHMARKS[name](detector, frames)
+            except Exception as e:
+                results[name] = {'error': repr(e)}
+            print(f"  {results[name]}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'model': args.model or f'stub(n_boxes={args.boxes}, delay_ms={args.delay_ms})',
+            'frames': len(frames),
+            'clip': args.clip
+        },
+        'results': results
+    }
+    output = args.output or os.path.join('bench_results', f'{commit}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fruit detection performance benchmarks")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument('--clip', help="Recorded video to use instead of synthetic frames")
+    parser.add_argument('--frames', type=int, default=60, help="Number of synthetic frames")
+    parser.add_argument('--model', help="Real weights to benchmark instead of the stub model")
+    parser.add_argument('--boxes', type=int, default=5, help="Boxes per frame returned by the stub model")
+    parser.add_argument('--delay-ms', type=float, default=0.0, help="Simulated stub inference time")
+    parser.add_argument('--output', help="Where to write the JSON results")
+    parser.add_argument('--compare', help="Baseline JSON to compare against")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
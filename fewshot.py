@@ -0,0 +1,271 @@
+"""
+Few-shot fruit registry: recognise a newly saved fruit/condition within
+seconds of "Save Data", without retraining YOLO.
+
+Saved crops are embedded with a small CPU backbone and kept in an in-memory
+nearest-neighbour index (saved to embeddings.npz). Tracked boxes are then
+classified by their k nearest enrolled crops; the full detector retrain
+becomes an optional batch job.
+
+    python fewshot.py rebuild     # re-embed every sample in the fruits.db catalog
+    python fewshot.py stats
+
+The backbone is MobileNetV3-Small (torchvision, ImageNet weights). If torch or
+the weights aren't available, a colour/texture histogram is used instead
+(FRUIT_EMBEDDER=histogram forces it).
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+REGISTRY_PATH = 'embeddings.npz'
+
+
+class HistogramEmbedder:
+    """HSV colour histogram + gradient orientation histogram, no model needed."""
+    name = 'histogram'
+    threshold = 0.85
+
+    def embed(self, crops):
+        out = []
+        for crop in crops:
+            crop = cv2.resize(crop, (64, 64), interpolation=cv2.INTER_AREA)
+            hsv = cv2.cvtColor(crop, cv2.COLOR_BGR2HSV)
+            color = cv2.calcHist([hsv], [0, 1, 2], None, [8, 8, 4], [0, 180, 0, 256, 0, 256]).ravel()
+            gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY).astype(np.float32)
+            mag, ang = cv2.cartToPolar(cv2.Sobel(gray, cv2.CV_32F, 1, 0), cv2.Sobel(gray, cv2.CV_32F, 0, 1))
+            texture = np.histogram(ang, bins=16, range=(0, 2 * np.pi), weights=mag)[0]
+            # Hellinger (sqrt of normalised histograms) so cosine similarity behaves
+            v = np.concatenate([np.sqrt(color / max(color.sum(), 1e-6)),
+                                0.5 * np.sqrt(texture / max(texture.sum(), 1e-6))]).astype(np.float32)
+            out.append(v)
+        return _normalize(np.array(out, np.float32).reshape(len(out), -1))
+
+
+class MobileNetEmbedder:
+    """Pooled MobileNetV3-Small features (576-d), a few ms per crop on CPU."""
+    name = 'mobilenet_v3_small'
+    threshold = 0.7
+    size = 160
+
+    def __init__(self):
+        import torch
+        from torchvision.models import mobilenet_v3_small, MobileNet_V3_Small_Weights
+        self.torch = torch
+        model = mobilenet_v3_small(weights=MobileNet_V3_Small_Weights.DEFAULT)
+        model.classifier = torch.nn.Identity()
+        self.model = model.eval()
+        self.mean = np.array([0.485, 0.456, 0.406], np.float32)
+        self.std = np.array([0.229, 0.224, 0.225], np.float32)
+
+    def embed(self, crops, batch_size=64):
+        out = [np.zeros((0, 576), np.float32)]
+        for i in range(0, len(crops), batch_size):
+            batch = np.stack([
+                (cv2.cvtColor(cv2.resize(c, (self.size, self.size), interpolation=cv2.INTER_AREA),
+                              cv2.COLOR_BGR2RGB).astype(np.float32) / 255 - self.mean) / self.std
+                for c in crops[i:i + batch_size]
+            ]).transpose(0, 3, 1, 2)
+            with self.torch.inference_mode():
+                out.append(self.model(self.torch.from_numpy(np.ascontiguousarray(batch))).numpy())
+        return _normalize(np.concatenate(out).astype(np.float32))
+
+
+def _normalize(v):
+    return v / np.maximum(np.linalg.norm(v, axis=1, keepdims=True), 1e-6)
+
+
+def load_embedder(name=None):
+    name = name or os.environ.get('FRUIT_EMBEDDER', 'mobilenet')
+    if name != 'histogram':
+        try:
+            return MobileNetEmbedder()
+        except Exception as e:
+            # No torchvision, or the weights can't be downloaded (offline)
+            print(f"MobileNet embedder unavailable ({e}), using colour histograms")
+    return HistogramEmbedder()
+
+
+class FewShotRegistry:
+    """
+    Nearest-neighbour index of enrolled crops labelled (fruit, condition).
+
+    Enrolment swaps in new arrays instead of growing them in place, so
+    classify() on the UI thread never sees a half-updated index. The
+    embedder (torch, maybe a weights download) is loaded on a background
+    thread; classify() returns no matches until it's there.
+    """
+    def __init__(self, path=REGISTRY_PATH, embedder=None, k=5, threshold=None, preload=False):
+        self.path = path
+        self.k = k
+        self._embedder = embedder
+        self._threshold = threshold
+        self._embedder_lock = threading.Lock()
+        self._loader = None
+        self._write_lock = threading.Lock()
+        # (vectors, label ids, [(fruit, condition)]) replaced as one tuple, never mutated
+        self._index = (np.zeros((0, 0), np.float32), np.zeros(0, np.int32), [])
+        self.embedder_name = None
+        self.load()
+        if preload and len(self):
+            self.load_embedder_async()
+
+    def __len__(self):
+        return len(self._index[1])
+
+    @property
+    def labels(self):
+        return self._index[2]
+
+    @property
+    def embedder(self):
+        with self._embedder_lock:
+            if self._embedder is None:
+                self._embedder = load_embedder(self.embedder_name)
+                if self.embedder_name and self._embedder.name != self.embedder_name and len(self):
+                    # Vectors from another backbone can't be compared, start over (see `rebuild`)
+                    print(f"{self.path} was built with {self.embedder_name}, run 'python fewshot.py rebuild'")
+                    self._swap(np.zeros((0, 0), np.float32), np.zeros(0, np.int32), [])
+                self.embedder_name = self._embedder.name
+            return self._embedder
+
+    @property
+    def ready(self):
+        return self._embedder is not None
+
+    def load_embedder_async(self):
+        with self._embedder_lock:
+            if self._embedder is not None or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=lambda: self.embedder, name="embedder-loader", daemon=True)
+            self._loader.start()
+
+    @property
+    def threshold(self):
+        return self._threshold if self._threshold is not None else self.embedder.threshold
+
+    @property
+    def strict_threshold(self):
+        # For boxes the detector doesn't consider fruit: half way between the threshold and a perfect match
+        return self.threshold + (1 - self.threshold) / 2
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data:
+            meta = json.loads(str(data['meta']))
+            self._swap(data['vectors'], data['label_ids'], [tuple(label) for label in meta['labels']])
+        self.embedder_name = meta['embedder']
+
+    def save(self):
+        buf = io.BytesIO()
+        vectors, label_ids, labels = self._index
+        meta = json.dumps({'embedder': self.embedder_name, 'labels': labels})
+        np.savez(buf, vectors=vectors, label_ids=label_ids, meta=np.array(meta))
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(buf.getvalue())
+        os.replace(self.path + '.tmp', self.path)
+
+    def _swap(self, vectors, label_ids, labels):
+        self._index = (vectors, label_ids, labels)
+
+    def enroll(self, fruit, condition, crops, save=True):
+        """Adds crops (BGR arrays) as examples of (fruit, condition). Returns how many were added."""
+        crops = [c for c in crops if c is not None and c.size]
+        if not crops:
+            return 0
+        t0 = time.perf_counter()
+        vectors = self.embedder.embed(crops)
+        with self._write_lock:
+            old_vectors, old_ids, labels = self._index
+            key = (fruit.lower(), condition)
+            labels = list(labels)
+            if key not in labels:
+                labels.append(key)
+            ids = np.full(len(vectors), labels.index(key), np.int32)
+            if not len(old_ids):
+                old_vectors = np.zeros((0, vectors.shape[1]), np.float32)
+            self._swap(np.vstack([old_vectors, vectors]), np.concatenate([old_ids, ids]), labels)
+            if save:
+                self.save()
+        print(f"Enrolled {len(crops)} samples of {fruit} ({condition}) in {time.perf_counter() - t0:.1f}s")
+        return len(crops)
+
+    def classify(self, crops, strict=None):
+        """
+        [(fruit, condition, score) or None] per crop; None when nothing enrolled
+        is close enough or the embedder is still loading. strict[i] = True
+        holds crop i to `strict_threshold`.
+        """
+        vectors, label_ids, labels = self._index
+        if not len(label_ids) or not len(crops):
+            return [None] * len(crops)
+        if not self.ready:
+            self.load_embedder_async()
+            return [None] * len(crops)
+        queries = self.embedder.embed(crops)
+        sims = queries @ vectors.T
+        k = min(self.k, sims.shape[1])
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+
+        strict = strict if strict is not None else [False] * len(crops)
+        results = []
+        for row, idx, is_strict in zip(sims, top, strict):
+            # Similarity-weighted vote among the k nearest enrolled crops
+            votes = np.bincount(label_ids[idx], weights=row[idx], minlength=len(labels))
+            best = int(np.argmax(votes))
+            score = float(row[idx][label_ids[idx] == best].mean())
+            threshold = self.strict_threshold if is_strict else self.threshold
+            results.append((*labels[best], score) if score >= threshold else None)
+        return results
+
+
+def rebuild(path=REGISTRY_PATH, db_path='fruits.db'):
+    """Re-embeds every sample in the fruits.db catalog (e.g. after switching embedder)."""
+    from store import FruitStore
+    from sample_archive import SampleArchive
+
+    store = FruitStore(db_path, json_path=None)
+    if os.path.exists(path):
+        os.remove(path)
+    registry = FewShotRegistry(path)
+    archives = {}
+    by_fruit = {}
+    for sample in store.samples():
+        by_fruit.setdefault(sample['fruit'], []).append(sample['path'])
+    for fruit, paths in sorted(by_fruit.items()):
+        record = store.get(fruit)
+        condition = record['condition'] if record else ''
+        crops = []
+        for p in paths:
+            root = os.path.dirname(p)
+            if os.path.exists(os.path.join(root, 'index.db')):
+                archive = archives.setdefault(root, SampleArchive(root))
+                crops.append(archive.read(p))
+            else:
+                crops.append(cv2.imread(p))
+        registry.enroll(fruit, condition, crops, save=False)
+    registry.save()
+    store.close()
+    return registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Few-shot fruit registry")
+    parser.add_argument('command', choices=['rebuild', 'stats'])
+    parser.add_argument('--path', default=REGISTRY_PATH)
+    args = parser.parse_args()
+    registry = rebuild(args.path) if args.command == 'rebuild' else FewShotRegistry(args.path)
+    counts = np.bincount(registry._index[1], minlength=len(registry.labels)) if len(registry) else []
+    print(f"{len(registry)} embeddings ({registry.embedder_name})")
+    for (fruit, condition), n in zip(registry.labels, counts):
+        print(f"  {fruit} ({condition}): {n}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+"""
+Shared local inference server: one loaded model for several front-ends.
+
+    python inference_server.py                      # user-only Unix socket (127.0.0.1:6000 on Windows)
+    python inference_server.py --address /tmp/fruit.sock --max-batch 8
+
+Clients (main.py, main_data_creation.py, kiosks on the same box) connect by
+setting FRUIT_SERVER (`1` for the default address, `host:port` or a socket
+path). Frames travel through a shared-memory block per client stream; only a
+small message with the block name and shape goes over the socket. Frames from
+all streams that arrive within `max_wait_ms` are run as one batch, each client
+stream keeps its own ByteTrack session, and a model reload requested by any
+client (e.g. after training) is pushed to all of them.
+
+The listener unpickles what clients send, so only clients holding the authkey
+get in: FRUIT_SERVER_KEY, or else a random key the server writes to
+~/.fruit_server_key (mode 0600) on first start.
+"""
+import argparse
+import collections
+import itertools
+import os
+import queue
+import secrets
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError, resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from utils import Detector, Detections, startup_report
+from metrics import metrics
+
+if os.name == 'posix':
+    DEFAULT_ADDRESS = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                                   f'fruit-server-{os.getuid()}.sock')
+else:
+    DEFAULT_ADDRESS = ('127.0.0.1', 6000)  # No AF_UNIX for multiprocessing.connection on Windows
+KEY_PATH = os.path.join(os.path.expanduser('~'), '.fruit_server_key')
+LEGACY_AUTHKEY = b'fruit-nutrition'  # The old built-in key, publicly known
+
+
+def load_authkey(create=False):
+    """FRUIT_SERVER_KEY, or the key in KEY_PATH (written with a random key first if `create`)."""
+    key = os.environ.get('FRUIT_SERVER_KEY')
+    if key:
+        return key.encode('utf-8')
+    if create:
+        try:
+            fd = os.open(KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    # No file yet (no server ever started) raises FileNotFoundError, clients fall back to a local model
+    with open(KEY_PATH, 'r') as f:
+        return f.read().strip().encode('utf-8')
+
+
+def parse_address(text):
+    """'1' / 'auto' -> default, 'host:port' -> TCP, anything else -> Unix socket path."""
+    if text in ('1', 'auto', 'default'):
+        return DEFAULT_ADDRESS
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit() and '/' not in text:
+        return (host or '127.0.0.1', int(port))
+    return text
+
+
+def _attach(name):
+    # Open a client's block without letting this process's resource tracker unlink it on exit
+    shm = SharedMemory(name=name)
+    if os.name == 'posix':
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class _Session:
+    """Server side of one connected client: its socket, frame blocks and tracked streams."""
+    def __init__(self, session_id, conn):
+        self.id = session_id
+        self.conn = conn
+        self.name = f'client-{session_id}'
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._shms = {}     # Client stream -> attached frame block
+        self.streams = set()  # Client streams the detector keeps a tracker for
+        self._names = None  # Class names this client was last sent
+
+    def send(self, msg):
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self.conn.send(msg)
+            except (OSError, EOFError):
+                self.closed = True
+
+    def stream_id(self, stream):
+        # Detector stream id: client streams of different sessions never share a tracker
+        self.streams.add(stream)
+        return (self.id, stream)
+
+    def read_frame(self, stream, shm_name, shape, dtype):
+        shm = self._shms.get(stream)
+        if shm is None or shm.name != shm_name:
+            if shm is not None:
+                shm.close()
+            shm = self._shms[stream] = _attach(shm_name)
+        # Copied out right away, the client reuses its block for the next frame
+        return np.array(np.ndarray(shape, dtype, buffer=shm.buf))
+
+    def send_result(self, seq, detections):
+        # Names only go out again when the model (and with it the class list) changed
+        names = detections.names if detections.names != self._names else None
+        self._names = detections.names
+        self.send(('result', seq, (names, detections.xyxy, detections.cls, detections.conf,
+                                   detections.ids, detections.is_fruit)))
+
+    def release(self):
+        for shm in self._shms.values():
+            shm.close()
+        self._shms.clear()
+
+
+class InferenceServer:
+    def __init__(self, detector, address=DEFAULT_ADDRESS, authkey=None, max_batch=8, max_wait_ms=5):
+        self.detector = detector
+        self.address = address
+        self.authkey = authkey or load_authkey(create=True)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.model_version = 0
+
+        self._requests = queue.Queue()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._stop = threading.Event()
+        self._listener = None
+        self.last_batch_size = 0
+
+        metrics.register('server_clients', lambda: len(self._sessions))
+        metrics.register('server_queue_depth', self._requests.qsize)
+        metrics.register('server_last_batch_size', lambda: self.last_batch_size)
+
+    def serve_forever(self):
+        if isinstance(self.address, tuple) and self.authkey == LEGACY_AUTHKEY:
+            raise ValueError("Refusing to listen on TCP with the publicly known default key, "
+                             "unset FRUIT_SERVER_KEY or pick a secret one")
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # Stale socket from a previous run
+        # Unix socket only reachable by this user (0600)
+        old_umask = os.umask(0o077) if isinstance(self.address, str) else None
+        try:
+            self._listener = Listener(self.address, authkey=self.authkey)
+        finally:
+            if old_umask is not None:
+                os.umask(old_umask)
+        threading.Thread(target=self._batch_loop, name="batcher", daemon=True).start()
+        threading.Thread(target=self._announce_ready, name="ready-watcher", daemon=True).start()
+        print(f"Inference server listening on {self.address}")
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn = self._listener.accept()
+                except (OSError, AuthenticationError):
+                    if self._stop.is_set():
+                        break
+                    continue  # Wrong authkey or a client that hung up during the handshake
+                session = _Session(next(self._ids), conn)
+                with self._sessions_lock:
+                    self._sessions[session.id] = session
+                threading.Thread(target=self._handle, args=(session,), name=f"session-{session.id}",
+                                 daemon=True).start()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        # Clients stop sending frames and report the server as gone
+        self.broadcast(('bye',))
+
+    def info(self):
+        model = self.detector.model
+        return {
+            'backend': self.detector.backend,
+            'imgsz': self.detector.imgsz,
+            'ready': self.detector.ready.is_set(),
+            'model_version': self.model_version,
+            'names': dict(model.names) if model is not None else {}
+        }
+
+    def broadcast(self, msg):
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.send(msg)
+
+    def _announce_ready(self):
+        # Clients may connect while the model is still loading, tell them when it's there
+        while not self.detector.ready.wait(0.5):
+            if self.detector.load_error is not None:
+                self.broadcast(('error', None, f"Model failed to load: {self.detector.load_error}"))
+                return
+        self.broadcast(('model', self.info()))
+
+    def _handle(self, session):
+        try:
+            while not self._stop.is_set():
+                msg = session.conn.recv()
+                kind = msg[0]
+                if kind == 'detect':
+                    _, seq, stream, shm_name, shape, dtype = msg
+                    self._requests.put((session.stream_id(stream), session, seq,
+                                        session.read_frame(stream, shm_name, shape, dtype)))
+                elif kind == 'hello':
+                    session.name = msg[1]
+                    print(f"{session.name} connected (session {session.id})")
+                    session.send(('hello', self.info()))
+                elif kind == 'reset':
+                    self._reset(session, msg[1])
+                elif kind == 'reload':
+                    _, req, weights = msg
+                    self.detector.reload_model(weights, block=False,
+                                               on_done=lambda ok, req=req: self._reloaded(session, req, ok))
+                elif kind == 'bye':
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._sessions_lock:
+                self._sessions.pop(session.id, None)
+            session.closed = True
+            session.conn.close()
+            session.release()
+            self._reset(session)
+            print(f"{session.name} disconnected")
+
+    def _reset(self, session, stream=None):
+        streams = list(session.streams) if stream is None else [stream]
+        for s in streams:
+            session.streams.discard(s)
+            self.detector.reset_stream((session.id, s))
+
+    def _reloaded(self, session, req, ok):
+        if ok:
+            self.model_version += 1
+            # Every client gets the new class list, not just the one that asked
+            self.broadcast(('model', self.info()))
+        session.send(('reloaded', req, ok))
+
+    def _batch_loop(self):
+        carry = collections.deque()  # Second request of a client already in the batch
+        while not self._stop.is_set():
+            if carry:
+                first = carry.popleft()
+            else:
+                try:
+                    first = self._requests.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+            # Wait a few ms for the other streams' frames, but never when there is nobody to wait for
+            batch = {first[0]: first}
+            with self._sessions_lock:
+                streams = sum(len(session.streams) for session in self._sessions.values())
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < min(self.max_batch, streams):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if req[0] in batch:
+                    carry.append(req)
+                    break
+                batch[req[0]] = req
+
+            self.last_batch_size = len(batch)
+            try:
+                with metrics.timer('server_batch'):
+                    results = self.detector.detect_and_track_streams({sid: req[3] for sid, req in batch.items()})
+            except Exception as e:
+                print(f"Inference error: {e}")
+                for _, session, seq, _ in batch.values():
+                    session.send(('error', seq, str(e)))
+                continue
+
+            for sid, (_, session, seq, _) in batch.items():
+                if session.closed:
+                    # Left while its frame was in flight, drop the tracker that was just made for it
+                    self.detector.reset_stream(sid)
+                else:
+                    session.send_result(seq, results[sid])
+
+
+class RemoteDetector(Detector):
+    """
+    Detector for the GUIs that leaves the model to an InferenceServer.
+
+    The fruit db, nutrition and ripeness still live here (they are cheap and
+    the db is shared through SQLite anyway); detect_and_track and reload_model
+    go to the server. `backend` is 'remote' so the InferenceScheduler keeps
+    its hands off imgsz, that's the server's call. No few-shot registry: a
+    thin client is meant to stay free of torch.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, timeout=5.0, name=None):
+        self._init_state('remote')
+
+        self.timeout = timeout
+        self.model_version = None
+        self.names = {}
+        self._result_names = {}
+        # Called with the server info whenever the server switched models
+        self.on_model_change = []
+
+        self._replies = {}
+        self._waiting = set()  # Reply keys someone is (about to be) waiting for
+        self._reply_cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._seq = 0
+        self._reload_ids = itertools.count(1)
+        self._shms = {}  # Stream -> SharedMemory block reused for its frames
+        self._closed = False
+
+        with startup_report.measure('server_connect'):
+            self._conn = Client(address, authkey=authkey or load_authkey())
+        threading.Thread(target=self._read_loop, name="server-reader", daemon=True).start()
+        self._expect('hello')
+        self._send(('hello', name or f'pid-{os.getpid()}'))
+        if self._wait('hello', timeout) is None:
+            self.close()
+            raise ConnectionError(f"No answer from inference server at {address}")
+
+    def _send(self, msg):
+        with self._send_lock:
+            self._conn.send(msg)
+
+    def _expect(self, key):
+        # Registered before the request goes out, so a fast reply isn't dropped
+        with self._reply_cond:
+            self._waiting.add(key)
+
+    def _wait(self, key, timeout):
+        with self._reply_cond:
+            self._reply_cond.wait_for(lambda: key in self._replies or self._closed, timeout)
+            self._waiting.discard(key)
+            return self._replies.pop(key, None)
+
+    def _reply(self, key, value):
+        with self._reply_cond:
+            if key not in self._waiting:
+                return  # Late answer to a request that already timed out
+            self._replies[key] = value
+            self._reply_cond.notify_all()
+
+    def _apply_info(self, info):
+        self.model_version = info['model_version']
+        self.names = info['names']
+        self.imgsz = info['imgsz']
+        if info['ready']:
+            self.ready.set()
+
+    def _read_loop(self):
+        try:
+            while True:
+                msg = self._conn.recv()
+                kind = msg[0]
+                if kind == 'result' or (kind == 'error' and msg[1] is not None):
+                    self._reply(('result', msg[1]), msg)
+                elif kind == 'model':
+                    changed = self.model_version is not None and msg[1]['model_version'] != self.model_version
+                    self._apply_info(msg[1])
+                    if changed:
+                        print(f"Server switched to model version {self.model_version}")
+                    for callback in self.on_model_change:
+                        callback(msg[1])
+                elif kind == 'reloaded':
+                    self._reply(('reload', msg[1]), msg[2])
+                elif kind == 'hello':
+                    self._apply_info(msg[1])
+                    self._reply('hello', msg[1])
+                elif kind == 'error':
+                    self.load_error = RuntimeError(msg[2])
+                    print(f"Inference server: {msg[2]}")
+                elif kind == 'bye':
+                    self.load_error = ConnectionError("Inference server stopped")
+                    print(self.load_error)
+                    break
+        except (EOFError, OSError):
+            if not self._closed:
+                self.load_error = ConnectionError("Inference server went away")
+                print(self.load_error)
+        finally:
+            self.ready.clear()
+            with self._reply_cond:
+                self._closed = True
+                self._reply_cond.notify_all()
+
+    def detect_and_track(self, frame):
+        return self.detect_and_track_streams({None: frame})[None]
+
+    def detect_and_track_streams(self, frames):
+        # Every stream keeps its own tracker on the server, all frames go out before waiting
+        # so the server can put them in one batch
+        if not self.ready.is_set():
+            return {stream: Detections.empty(self.names) for stream in frames}
+
+        pending = {}
+        with metrics.timer('server_roundtrip'):
+            for stream, frame in frames.items():
+                shm_name = self._put_frame(stream, np.ascontiguousarray(frame))
+                self._seq += 1
+                pending[stream] = ('result', self._seq)
+                self._expect(pending[stream])
+                self._send(('detect', self._seq, stream, shm_name, frame.shape, frame.dtype.str))
+            deadline = time.perf_counter() + self.timeout
+            replies = {stream: self._wait(key, max(0.0, deadline - time.perf_counter()))
+                       for stream, key in pending.items()}
+
+        results = {}
+        for stream, msg in replies.items():
+            if msg is None or msg[0] == 'error':
+                metrics.inc('server_errors_total')
+                results[stream] = Detections.empty(self.names)
+                continue
+            names, xyxy, cls, conf, ids, is_fruit = msg[2]
+            if names is not None:
+                self._result_names = names
+            results[stream] = Detections(xyxy, cls, conf, ids, is_fruit, self._result_names)
+        return results
+
+    def _put_frame(self, stream, frame):
+        shm = self._shms.get(stream)
+        if shm is None or shm.size < frame.nbytes:
+            self._release_shm(stream)
+            shm = self._shms[stream] = SharedMemory(create=True, size=frame.nbytes)
+        np.ndarray(frame.shape, frame.dtype, buffer=shm.buf)[:] = frame
+        return shm.name
+
+    def reset_stream(self, stream_id=None):
+        self._send(('reset', stream_id))
+
+    def reload_model(self, weights='best.pt', block=True, on_done=None):
+        # Same contract as Detector.reload_model, the server does the load / check / swap
+        if not block:
+            threading.Thread(target=self.reload_model, args=(weights, True, on_done), name="model-swap", daemon=True).start()
+            return None
+        req = next(self._reload_ids)
+        self._expect(('reload', req))
+        self._send(('reload', req, weights))
+        ok = bool(self._wait(('reload', req), None))
+        if on_done:
+            on_done(ok)
+        return ok
+
+    def _release_shm(self, stream=None):
+        for key in list(self._shms) if stream is None else [stream]:
+            shm = self._shms.pop(key, None)
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        was_closed, self._closed = self._closed, True
+        if not was_closed:
+            try:
+                self._send(('bye',))
+            except OSError:
+                pass
+        self._conn.close()
+        self._release_shm()
+
+
+def create_detector(load_async=True, fewshot=False):
+    """Thin client if FRUIT_SERVER is set (and reachable), otherwise the model is loaded in this process."""
+    address = os.environ.get('FRUIT_SERVER')
+    if address:
+        try:
+            return RemoteDetector(parse_address(address))
+        except (ConnectionError, OSError, AuthenticationError) as e:
+            print(f"Inference server {address} not reachable ({e}), loading the model locally")
+    return Detector(load_async=load_async, fewshot=fewshot)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve one Detector to several local front-ends")
+    parser.add_argument('--address', default='1', help="host:port or a Unix socket path (default: per-user socket)")
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=5, help="How long a frame waits for others to batch with")
+    args = parser.parse_args()
+
+    metrics.start_from_env()
+    # Clients can connect right away, they are told when the model is ready
+    detector = Detector(load_async=True)
+    server = InferenceServer(detector, parse_address(args.address), max_batch=args.max_batch,
+                             max_wait_ms=args.max_wait_ms)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping inference server")
+        metrics.stop()
+
+
+if __name__ == "__main__":
+    main()
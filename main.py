@@ -1,8 +1,12 @@
 import tkinter as tk
 import customtkinter as ctk
-import cv2
-from PIL import Image, ImageTk
-from utils import Detector
+from utils import startup_report
+from inference_server import create_detector
+from metrics import metrics
+from pipeline import FramePipeline
+from scheduler import InferenceScheduler
+from render import FrameRenderer, PanelUpdater
+from track_cache import TrackCache
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("green")
@@ -13,8 +17,19 @@ class MainApp(ctk.CTk):
         self.title("Fruit Recognition System - Production")
         self.geometry("1000x600")
 
-        self.detector = Detector()
-        self.cap = cv2.VideoCapture(0)
+        # Stage timings / Prometheus endpoint, only if FRUIT_METRICS_PORT or FRUIT_METRICS_DUMP is set
+        metrics.start_from_env()
+
+        # Model loads and warms up in the background, the window shows up immediately.
+        # With FRUIT_SERVER set this is a thin client of a shared inference_server.py instead
+        self.detector = create_detector(load_async=True, fewshot=True)
+        self._startup_reported = False
+        # Capture and inference run on their own threads, Tk only renders
+        # The scheduler skips YOLO on static frames and keeps inference inside a latency budget
+        # Class votes, few-shot matches and ripeness per ByteTrack id are kept on the inference thread too
+        self.pipeline = FramePipeline(self.detector, source=0, scheduler=InferenceScheduler(self.detector),
+                                      tracks=TrackCache(self.detector)).start()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # UI Layout
         self.grid_columnconfigure(0, weight=3)
@@ -27,6 +42,9 @@ class MainApp(ctk.CTk):
         
         self.video_label = ctk.CTkLabel(self.video_frame, text="")
         self.video_label.pack(expand=True, fill="both")
+        self.renderer = FrameRenderer(
+            self.video_label, size_fn=lambda: (self.video_frame.winfo_width(), self.video_frame.winfo_height()))
+        self.panel = PanelUpdater()
 
         # Info Section
         self.info_panel = ctk.CTkFrame(self)
@@ -44,63 +62,77 @@ class MainApp(ctk.CTk):
         self.nutrition_text = ctk.CTkLabel(self.info_panel, text="", font=ctk.CTkFont(size=14), justify="left")
         self.nutrition_text.pack(pady=5)
         
-        ctk.CTkLabel(self.info_panel, text="System: Active", text_color="green").pack(side="bottom", pady=20)
+        self.status_label = ctk.CTkLabel(self.info_panel, text="System: Loading model...", text_color="orange")
+        self.status_label.pack(side="bottom", pady=20)
 
         self.update_video()
 
+    def on_close(self):
+        self.pipeline.stop()
+        self.detector.close()
+        metrics.stop()
+        self.destroy()
+
+    def update_model_status(self):
+        if self._startup_reported:
+            return
+        if self.detector.ready.is_set():
+            self.status_label.configure(text="System: Active", text_color="green")
+            # Summary once the pipeline has run the first frame through the model
+            if 'first_frame' in startup_report:
+                print(startup_report.summary())
+                self._startup_reported = True
+        elif self.detector.load_error is not None:
+            self.status_label.configure(text="System: Model failed to load", text_color="red")
+            self._startup_reported = True
+
+    @staticmethod
+    def format_nutrition(track):
+        nutri = track.nutrition
+        if not nutri:
+            return "No data available"
+        info = f"Calories: {nutri.get('calories', 'N/A')}\n"
+        info += f"Carbs: {nutri.get('carbs', 'N/A')}\n"
+        info += f"Fiber: {nutri.get('fiber', 'N/A')}"
+        return info
+
     def update_video(self):
-        ret, frame = self.cap.read()
-        if ret:
-            frame = cv2.flip(frame, 1)
-            detections = self.detector.detect_and_track(frame)
+        self.update_model_status()
+        result = self.pipeline.get_result()
+        if result is not None:
+            frame, detections, tracks = result
             
-            display_frame = frame.copy()
+            boxes = []
             found_fruit = None
             
-            for d in detections:
-                if d['is_fruit']:
-                    x1, y1, x2, y2 = d['bbox']
+            # Smoothed class, ripeness and db/nutrition record per ByteTrack id
+            for t in tracks:
+                if t.is_fruit:
                     # Use Green box for recognition
-                    cv2.rectangle(display_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.putText(display_frame, f"{d['name']}", (x1, y1-10), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-                    found_fruit = d
+                    label = f"{t.name} ({t.ripeness})" if t.ripeness else t.name
+                    boxes.append((t.bbox, label, (0, 255, 0)))
+                    found_fruit = t
                     break # Focus on the first detected fruit for the side panel
 
+            # Widgets are only reconfigured when their text really changes
             if found_fruit:
-                name = found_fruit['name']
                 # Check database
-                if name.lower() in self.detector.db:
-                    condition = self.detector.db[name.lower()]['condition']
-                    display_name = name
-                    
-                    self.res_name_label.configure(text=f"Fruit: {display_name.capitalize()}")
-                    self.res_cond_label.configure(text=f"Condition: {condition}")
-                    
-                    # Show nutrition info
-                    nutri = self.detector.get_nutrition(display_name)
-                    if nutri:
-                        info = f"Calories: {nutri.get('calories', 'N/A')}\n"
-                        info += f"Carbs: {nutri.get('carbs', 'N/A')}\n"
-                        info += f"Fiber: {nutri.get('fiber', 'N/A')}"
-                        self.nutrition_text.configure(text=info)
-                    else:
-                        self.nutrition_text.configure(text="No data available")
+                if found_fruit.record is not None:
+                    self.panel.configure(self.res_name_label, text=f"Fruit: {found_fruit.name.capitalize()}")
+                    self.panel.configure(self.res_cond_label, text=f"Condition: {found_fruit.condition}")
+                    # Show nutrition info (formatted once per track and class)
+                    self.panel.configure(self.nutrition_text, text=found_fruit.memo('nutrition', self.format_nutrition))
                 else:
-                    self.res_name_label.configure(text="Fruit: Unknown (Not in DB)")
-                    self.res_cond_label.configure(text="Condition: -")
-                    self.nutrition_text.configure(text="Please train this fruit first")
+                    self.panel.configure(self.res_name_label, text="Fruit: Unknown (Not in DB)")
+                    self.panel.configure(self.res_cond_label, text="Condition: -")
+                    self.panel.configure(self.nutrition_text, text="Please train this fruit first")
             else:
-                self.res_name_label.configure(text="Fruit: Searching...")
-                self.res_cond_label.configure(text="Condition: -")
-                self.nutrition_text.configure(text="")
+                self.panel.configure(self.res_name_label, text="Fruit: Searching...")
+                self.panel.configure(self.res_cond_label, text="Condition: -")
+                self.panel.configure(self.nutrition_text, text="")
 
-            # Convert to PhotoImage for TK
-            img = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-            img = Image.fromarray(img)
-            img = ImageTk.PhotoImage(image=img)
-            self.video_label.imgtk = img
-            self.video_label.configure(image=img)
+            # Scaled down to the video area and pasted into a reused PhotoImage
+            self.renderer.render(frame, boxes)
             
         self.after(10, self.update_video)
 
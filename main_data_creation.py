@@ -1,12 +1,21 @@
 import tkinter as tk
 import customtkinter as ctk
-import cv2
-from PIL import Image, ImageTk
 import threading
-from utils import Detector
+from utils import startup_report
+from inference_server import create_detector
+from metrics import metrics
+from pipeline import FramePipeline
+from scheduler import InferenceScheduler
+from render import FrameRenderer, PanelUpdater
+from track_cache import TrackCache
+from sample_writer import SampleWriter
+from sample_selector import SampleSelector
+from resources import TrainingBudget, TrainingGovernor
 import os
 import subprocess
 import sys
+import json
+from train import PROGRESS_PREFIX
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
@@ -17,10 +26,26 @@ class App(ctk.CTk):
         self.title("Fruit Detection & Data Creation Tool")
         self.geometry("1100x700")
 
-        self.detector = Detector()
-        self.cap = cv2.VideoCapture(0)
+        # Stage timings / Prometheus endpoint, only if FRUIT_METRICS_PORT or FRUIT_METRICS_DUMP is set
+        metrics.start_from_env()
+
+        # Model loads and warms up in the background, the window shows up immediately.
+        # With FRUIT_SERVER set this is a thin client of a shared inference_server.py instead
+        self.detector = create_detector(load_async=True, fewshot=True)
+        self._startup_reported = False
+        # Capture and inference run on their own threads, Tk only renders
+        # The scheduler skips YOLO on static frames and keeps inference inside a latency budget
+        # Class votes, few-shot matches and ripeness per ByteTrack id are kept on the inference thread too.
+        # Recognition (ripeness, few-shot) is off while adding data, see show_add_data / show_recognize
+        self.pipeline = FramePipeline(self.detector, source=0, scheduler=InferenceScheduler(self.detector),
+                                      tracks=TrackCache(self.detector), recognize=False).start()
+        self.train_governor = None  # Set while a training run shares the CPU with the live view
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         self.is_capturing = False
-        self.samples = []
+        # Crops are encoded and written in the background while capturing
+        self.sample_writer = SampleWriter()
+        # Skips near-duplicate crops so we don't store 30 copies of the same view per second
+        self.sample_selector = SampleSelector()
         self.current_frame = None
         
         # UI Layout
@@ -40,6 +65,9 @@ class App(ctk.CTk):
         self.recognize_btn = ctk.CTkButton(self.sidebar, text="Recognize", command=self.show_recognize)
         self.recognize_btn.pack(pady=10, padx=10)
 
+        self.status_label = ctk.CTkLabel(self.sidebar, text="Model: loading...", text_color="orange")
+        self.status_label.pack(side="bottom", pady=20)
+
         # Main Area
         self.main_frame = ctk.CTkFrame(self)
         self.main_frame.grid(row=0, column=1, padx=20, pady=20, sticky="nsew")
@@ -52,6 +80,12 @@ class App(ctk.CTk):
         # Control Panel (Right side)
         self.control_panel = ctk.CTkFrame(self.main_frame)
         self.control_panel.grid(row=0, column=1, sticky="nsew", padx=10, pady=10)
+
+        # Video gets whatever the control panel leaves of the main area (minus grid padding)
+        self.renderer = FrameRenderer(self.video_label, size_fn=lambda: (
+            self.main_frame.winfo_width() - self.control_panel.winfo_width() - 40,
+            self.main_frame.winfo_height() - 20))
+        self.panel = PanelUpdater()
         
         self.mode = "add_data" # Default mode
         self.setup_add_data_ui()
@@ -62,6 +96,7 @@ class App(ctk.CTk):
         # Clear control panel
         for widget in self.control_panel.winfo_children():
             widget.destroy()
+        self.panel.reset()
             
         ctk.CTkLabel(self.control_panel, text="Add Data Mode", font=ctk.CTkFont(size=16, weight="bold")).pack(pady=10)
         
@@ -86,6 +121,10 @@ class App(ctk.CTk):
         self.save_btn = ctk.CTkButton(self.control_panel, text="Save Data", command=self.save_data)
         self.save_btn.pack(pady=10, padx=10, fill="x")
         
+        # Saved samples are recognised right away by the few-shot registry, retraining YOLO is optional
+        self.retrain_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(self.control_panel, text="Retrain detector after save", variable=self.retrain_var).pack(pady=5, padx=10)
+        
         ctk.CTkLabel(self.control_panel, text="--- OR ---").pack(pady=5)
         
         self.train_btn = ctk.CTkButton(self.control_panel, text="Train Model", fg_color="purple", command=self.start_training)
@@ -94,6 +133,7 @@ class App(ctk.CTk):
     def setup_recognize_ui(self):
         for widget in self.control_panel.winfo_children():
             widget.destroy()
+        self.panel.reset()
             
         ctk.CTkLabel(self.control_panel, text="Recognition Mode", font=ctk.CTkFont(size=16, weight="bold")).pack(pady=10)
         
@@ -109,15 +149,18 @@ class App(ctk.CTk):
 
     def show_add_data(self):
         self.mode = "add_data"
+        self.pipeline.recognize = False
         self.setup_add_data_ui()
 
     def show_recognize(self):
         self.mode = "recognize"
+        self.pipeline.recognize = True
         self.setup_recognize_ui()
 
     def start_capture(self):
         self.is_capturing = True
-        self.samples = []
+        self.sample_writer.discard()
+        self.sample_selector.reset()
 
     def stop_capture(self):
         self.is_capturing = False
@@ -129,107 +172,171 @@ class App(ctk.CTk):
             print("Please enter name and condition")
             return
         
-        if not self.samples:
+        # Waits for the last pending writes, the crops themselves are already on disk
+        samples = self.sample_writer.take()
+        if not samples:
             print("No samples captured")
             return
             
-        self.detector.save_fruit_data(name, cond, self.samples)
-        self.samples = []
-        self.sample_label.configure(text="Samples taken: 0")
-        print(f"Data saved for {name}. Starting training automatically...")
-        
-        # Automatically trigger training
-        self.start_training()
+        print(self.sample_selector.report())
+        self.detector.save_fruit_data(name, cond, samples)
+        self.panel.configure(self.sample_label, text="Samples taken: 0")
+        if self.retrain_var.get():
+            print(f"Data saved for {name}. Starting training automatically...")
+            # Warm start from best.pt, only what changed
+            self.start_training(incremental=True)
+        else:
+            print(f"Data saved for {name}. It is recognised from its samples now, "
+                  f"use Train Model for a full retrain of the detector.")
 
-    def start_training(self):
+    def start_training(self, incremental=False):
         self.train_btn.configure(state="disabled", text="Training...")
-        threading.Thread(target=self.run_train_script, daemon=True).start()
+        threading.Thread(target=self.run_train_script, args=(incremental,), daemon=True).start()
 
-    def run_train_script(self):
+    def set_train_status(self, text, **kwargs):
+        # Called from the training thread; the button is gone while in recognize mode
+        def update():
+            if self.train_btn.winfo_exists():
+                self.train_btn.configure(text=text, **kwargs)
+        self.after(0, update)
+
+    def show_train_progress(self, event):
+        if event['event'] == 'epoch':
+            eta = int(event['eta_seconds'])
+            self.set_train_status(f"Epoch {event['epoch']}/{event['epochs']} - ETA {eta // 60}m{eta % 60:02d}s")
+            print(f"Epoch {event['epoch']}/{event['epochs']}: {event['metrics']}")
+
+    def run_train_script(self, incremental=False):
+        # Trainer and live view get their own cores and thread budgets, training runs at low priority
+        budget = TrainingBudget()
+        print(budget)
         try:
-            # Run the train.py script
-            result = subprocess.run([sys.executable, "train.py"], capture_output=True, text=True)
-            print(result.stdout)
-            if result.returncode == 0:
+            # Run the train.py script, streaming its output instead of waiting for the end
+            cmd = [sys.executable, "train.py"] + (["--incremental"] if incremental else []) + budget.command_args()
+            old_mtime = os.path.getmtime('best.pt') if os.path.exists('best.pt') else None
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+                                    env=budget.env(), **budget.popen_kwargs())
+            budget.apply_live()
+            # Throttles/pauses training whenever the live frame latency goes over target
+            self.train_governor = TrainingGovernor(proc, self.pipeline.frame_latency).start()
+            try:
+                for line in proc.stdout:
+                    if line.startswith(PROGRESS_PREFIX):
+                        self.show_train_progress(json.loads(line[len(PROGRESS_PREFIX):]))
+                    else:
+                        print(line, end='')
+                returncode = proc.wait()
+            finally:
+                self.train_governor.stop()
+                self.train_governor = None
+                budget.restore_live()
+
+            if returncode == 0:
                 print("Training finished successfully.")
-                self.detector.reload_model()
-                self.after(0, lambda: self.train_btn.configure(state="normal", text="Training Done!", fg_color="green"))
+                new_mtime = os.path.getmtime('best.pt') if os.path.exists('best.pt') else None
+                # Loads, warms up and checks the new model while recognition keeps running
+                if new_mtime == old_mtime or self.detector.reload_model():
+                    self.set_train_status("Training Done!", state="normal", fg_color="green")
+                else:
+                    self.set_train_status("New Model Rejected", state="normal", fg_color="red")
             else:
-                print(f"Training failed: {result.stderr}")
-                self.after(0, lambda: self.train_btn.configure(state="normal", text="Error in Training", fg_color="red"))
+                print(f"Training failed (exit code {returncode})")
+                self.set_train_status("Error in Training", state="normal", fg_color="red")
         except Exception as e:
             print(f"Error starting training: {e}")
-            self.after(0, lambda: self.train_btn.configure(state="normal", text="Error", fg_color="red"))
+            self.set_train_status("Error", state="normal", fg_color="red")
+
+    def on_close(self):
+        governor = self.train_governor
+        if governor is not None:
+            # Never leave a suspended trainer behind
+            governor.stop()
+        self.pipeline.stop()
+        self.detector.close()
+        self.sample_writer.discard()
+        self.sample_writer.close()
+        metrics.stop()
+        self.destroy()
+
+    def update_model_status(self):
+        if self._startup_reported:
+            return
+        if self.detector.ready.is_set():
+            self.status_label.configure(text="Model: ready", text_color="green")
+            # Summary once the pipeline has run the first frame through the model
+            if 'first_frame' in startup_report:
+                print(startup_report.summary())
+                self._startup_reported = True
+        elif self.detector.load_error is not None:
+            self.status_label.configure(text="Model: failed to load", text_color="red")
+            self._startup_reported = True
+
+    @staticmethod
+    def format_nutrition(track):
+        nutri = track.nutrition
+        if not nutri:
+            return "Nutritional Info:\nNo data available"
+        info = f"Calories: {nutri.get('calories', 'N/A')}\n"
+        info += f"Carbs: {nutri.get('carbs', 'N/A')}\n"
+        info += f"Fiber: {nutri.get('fiber', 'N/A')}\n"
+        if 'vitamin_c' in nutri: info += f"Vit C: {nutri['vitamin_c']}\n"
+        if 'potassium' in nutri: info += f"Potassium: {nutri['potassium']}\n"
+        return f"Nutritional Info:\n{info}"
 
     def update_video(self):
-        ret, frame = self.cap.read()
-        if ret:
-            frame = cv2.flip(frame, 1)
-            detections = self.detector.detect_and_track(frame)
-            
-            display_frame = frame.copy()
+        self.update_model_status()
+        result = self.pipeline.get_result()
+        if result is not None:
+            frame, detections, tracks = result
             
+            boxes = []
             found_fruit = None
             
-            for d in detections:
-                if d['is_fruit']:
-                    x1, y1, x2, y2 = d['bbox']
+            # Smoothed class, ripeness and db/nutrition record per ByteTrack id
+            for t in tracks:
+                if t.is_fruit:
+                    x1, y1, x2, y2 = t.bbox
                     # Requirement: Blue square for tracking in add_data
                     # Use a generic label in add_data mode to avoid confusion with default classes
-                    label = "Tracking Object..." if self.mode == "add_data" else f"{d['name']} {d['conf']:.2f}"
+                    if self.mode == "add_data":
+                        label = "Tracking Object..."
+                    else:
+                        label = f"{t.name} {t.conf:.2f}" + (f" ({t.ripeness})" if t.ripeness else "")
                     color = (255, 0, 0) if self.mode == "add_data" else (0, 255, 0)
+                    boxes.append((t.bbox, label, color))
                     
-                    cv2.rectangle(display_frame, (x1, y1), (x2, y2), color, 2)
-                    cv2.putText(display_frame, label, (x1, y1-10), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-                    
-                    found_fruit = d
+                    found_fruit = t
                     
                     if self.is_capturing:
+                        # Crops come from the full-resolution frame, not the scaled-down display
                         crop = frame[y1:y2, x1:x2]
-                        if crop.size > 0:
-                            self.samples.append(crop)
-                            self.sample_label.configure(text=f"Samples taken: {len(self.samples)}")
+                        if crop.size > 0 and self.sample_selector.consider(crop):
+                            # Non-blocking: if the writer falls behind the crop is dropped, not the UI
+                            self.sample_writer.submit(crop, block=False)
+                        self.panel.configure(self.sample_label,
+                                             text=f"Samples taken: {self.sample_writer.progress()['submitted']} "
+                                                  f"(skipped {self.sample_selector.dropped})")
 
+            # Widgets are only reconfigured when their text really changes
             if self.mode == "recognize" and found_fruit:
-                name = found_fruit['name']
                 # Requirement: Only show the train data from the database
-                if name.lower() in self.detector.db:
-                    condition = self.detector.db[name.lower()]['condition']
-                    display_name = name
-                    
-                    self.res_name_label.configure(text=f"Fruit: {display_name.capitalize()}")
-                    self.res_cond_label.configure(text=f"Condition: {condition}")
+                if found_fruit.record is not None:
+                    self.panel.configure(self.res_name_label, text=f"Fruit: {found_fruit.name.capitalize()}")
+                    self.panel.configure(self.res_cond_label, text=f"Condition: {found_fruit.condition}")
                     
-                    # Update nutrition info
-                    nutri = self.detector.get_nutrition(display_name)
-                    if nutri:
-                        info = f"Calories: {nutri.get('calories', 'N/A')}\n"
-                        info += f"Carbs: {nutri.get('carbs', 'N/A')}\n"
-                        info += f"Fiber: {nutri.get('fiber', 'N/A')}\n"
-                        if 'vitamin_c' in nutri: info += f"Vit C: {nutri['vitamin_c']}\n"
-                        if 'potassium' in nutri: info += f"Potassium: {nutri['potassium']}\n"
-                        self.nutrition_panel.delete("0.0", "end")
-                        self.nutrition_panel.insert("0.0", f"Nutritional Info:\n{info}")
-                    else:
-                        self.nutrition_panel.delete("0.0", "end")
-                        self.nutrition_panel.insert("0.0", "Nutritional Info:\nNo data available")
+                    # Update nutrition info (formatted once per track and class)
+                    self.panel.set_text(self.nutrition_panel, found_fruit.memo('nutrition', self.format_nutrition))
                 else:
                     # Found by YOLO but NOT in database - don't show info
-                    self.res_name_label.configure(text="Fruit: Unknown (Not in DB)")
-                    self.res_cond_label.configure(text="Condition: -")
-                    self.nutrition_panel.delete("0.0", "end")
-                    self.nutrition_panel.insert("0.0", "Nutritional Info:\nPlease train this fruit first")
+                    self.panel.configure(self.res_name_label, text="Fruit: Unknown (Not in DB)")
+                    self.panel.configure(self.res_cond_label, text="Condition: -")
+                    self.panel.set_text(self.nutrition_panel, "Nutritional Info:\nPlease train this fruit first")
             elif self.mode == "recognize":
-                self.res_name_label.configure(text="Fruit: Searching...")
-                self.res_cond_label.configure(text="Condition: -")
-
-            # Convert to PhotoImage
-            img = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-            img = Image.fromarray(img)
-            img = ImageTk.PhotoImage(image=img)
-            self.video_label.imgtk = img
-            self.video_label.configure(image=img)
+                self.panel.configure(self.res_name_label, text="Fruit: Searching...")
+                self.panel.configure(self.res_cond_label, text="Condition: -")
+
+            # Scaled down to the video area and pasted into a reused PhotoImage
+            self.renderer.render(frame, boxes)
             
         self.after(10, self.update_video)
 
@@ -0,0 +1,317 @@
+"""
+Built-in latency metrics for the live apps.
+
+Stages (capture, inference, postprocess, ripeness, render, disk_write, ...) are
+timed with `metrics.timer(stage)`; queue depths and drop counters are read
+through callbacks only when someone asks for them. Everything is off by default
+and a disabled timer is a shared no-op context, so the hot loops pay one
+attribute check per stage.
+
+Switch it on with environment variables before starting an app:
+
+    FRUIT_METRICS_PORT=9108            -> http://127.0.0.1:9108/metrics (Prometheus text)
+                                          /metrics.json, /profile/start, /profile/stop
+    FRUIT_METRICS_DUMP=metrics.json    -> rewritten every FRUIT_METRICS_INTERVAL seconds (default 10)
+"""
+import bisect
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Histogram bucket upper bounds in seconds (Prometheus "le")
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+WINDOW = 1024  # Samples kept per stage for the rolling percentiles
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 't0')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class _Stage:
+    """Cumulative histogram (for Prometheus) plus a rolling window (for percentiles)."""
+    __slots__ = ('buckets', 'count', 'sum', 'recent')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+        pct = lambda q: round(recent[min(len(recent) - 1, int(q * len(recent)))] * 1000, 3) if recent else None
+        return {
+            'count': self.count,
+            'mean_ms': round(self.sum / self.count * 1000, 3) if self.count else None,
+            'p50_ms': pct(0.50),
+            'p95_ms': pct(0.95),
+            'p99_ms': pct(0.99),
+            'max_ms': round(recent[-1] * 1000, 3) if recent else None
+        }
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every `interval` seconds; percentages are
+    the share of samples a function was seen on that thread.
+    cProfile only sees the thread that enables it, but the time here is spent on
+    the capture / inference / writer threads, so this looks at all of them.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._self_counts = collections.Counter()
+        self._total_counts = collections.Counter()
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._self_counts.clear()
+        self._total_counts.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return self.report()
+        self._stop.set()
+        self._thread.join(timeout=2)
+        self._thread = None
+        return self.report()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread = names.get(ident, str(ident))
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = f"[{thread}] {code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    if leaf:
+                        self._self_counts[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        # Recursive functions only count once per sample
+                        self._total_counts[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+            self.samples += 1
+
+    def report(self, top=25):
+        if not self.samples:
+            return "No samples collected"
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms",
+                 "", "Self time (where threads are right now):"]
+        lines += [f"  {n / self.samples * 100:6.1f}%  {key}" for key, n in self._self_counts.most_common(top)]
+        lines += ["", "Total time (function on the stack):"]
+        lines += [f"  {n / self.samples * 100:6.1f}%  {key}" for key, n in self._total_counts.most_common(top)]
+        return "\n".join(lines)
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.start = time.time()
+        self._stages = {}
+        self._counters = collections.Counter()
+        self._collectors = {}  # name -> (fn, kind, help)
+        self._lock = threading.Lock()
+        self.profiler = SamplingProfiler()
+        self._server = None
+        self._dump_stop = threading.Event()
+        self._dump_thread = None
+        self._dump_path = None
+
+    # --- Recording (hot path) ------------------------------------------------
+
+    def timer(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = _Stage()
+            s.add(seconds)
+
+    def inc(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += n
+
+    def register(self, name, fn, kind='gauge', help=''):
+        """fn() is called at scrape time only, e.g. lambda: len(queue). Re-registering replaces it."""
+        self._collectors[name] = (fn, kind, help)
+
+    # --- Reading -------------------------------------------------------------
+
+    def _collect(self):
+        values = {}
+        for name, (fn, kind, help) in list(self._collectors.items()):
+            try:
+                values[name] = (float(fn()), kind, help)
+            except Exception:
+                continue  # The owner went away (e.g. pipeline stopped)
+        return values
+
+    def snapshot(self):
+        with self._lock:
+            stages = {name: s.summary() for name, s in self._stages.items()}
+            counters = dict(self._counters)
+        return {
+            'timestamp': time.time(),
+            'uptime_s': round(time.time() - self.start, 1),
+            'stages': stages,
+            'counters': counters,
+            'gauges': {name: v for name, (v, _, _) in self._collect().items()},
+            'profiler_running': self.profiler.running
+        }
+
+    def prometheus(self):
+        lines = ["# HELP fruit_stage_seconds Time spent per pipeline stage",
+                 "# TYPE fruit_stage_seconds histogram"]
+        with self._lock:
+            for name, s in sorted(self._stages.items()):
+                cumulative = 0
+                for le, n in zip(BUCKETS + ('+Inf',), s.buckets):
+                    cumulative += n
+                    lines.append(f'fruit_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'fruit_stage_seconds_sum{{stage="{name}"}} {s.sum:.6f}')
+                lines.append(f'fruit_stage_seconds_count{{stage="{name}"}} {s.count}')
+            counters = dict(self._counters)
+        for name, n in sorted(counters.items()):
+            lines += [f"# TYPE fruit_{name} counter", f"fruit_{name} {n}"]
+        for name, (value, kind, help) in sorted(self._collect().items()):
+            if help:
+                lines.append(f"# HELP fruit_{name} {help}")
+            lines += [f"# TYPE fruit_{name} {kind}", f"fruit_{name} {value:g}"]
+        return "\n".join(lines) + "\n"
+
+    # --- Exporters -----------------------------------------------------------
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """Starts the HTTP endpoint on a daemon thread (localhost only by default)."""
+        if self._server is not None:
+            return self._server
+        self.enabled = True
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/metrics':
+                    self._send(metrics.prometheus(), 'text/plain; version=0.0.4')
+                elif url.path == '/metrics.json':
+                    self._send(json.dumps(metrics.snapshot(), indent=2), 'application/json')
+                elif url.path == '/profile/start':
+                    interval = parse_qs(url.query).get('interval_ms')
+                    if interval:
+                        metrics.profiler.interval = float(interval[0]) / 1000
+                    metrics.profiler.start()
+                    self._send("Profiler started\n", 'text/plain')
+                elif url.path == '/profile/stop':
+                    self._send(metrics.profiler.stop() + "\n", 'text/plain')
+                else:
+                    self.send_error(404)
+
+            def _send(self, body, content_type):
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass  # Keep scrapes out of the console
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"Metrics on http://{host}:{port}/metrics")
+        return self._server
+
+    def dump_every(self, path='metrics.json', interval=10.0):
+        """Rewrites `path` with snapshot() every `interval` seconds on a daemon thread."""
+        if self._dump_thread is not None:
+            return
+        self.enabled = True
+        self._dump_path = path
+        self._dump_stop.clear()
+
+        def run():
+            while not self._dump_stop.wait(interval):
+                self.dump(path)
+
+        self._dump_thread = threading.Thread(target=run, name="metrics-dump", daemon=True)
+        self._dump_thread.start()
+
+    def dump(self, path='metrics.json'):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=4)
+        os.replace(tmp, path)  # Readers never see a half-written file
+
+    def start_from_env(self):
+        port = os.environ.get('FRUIT_METRICS_PORT')
+        if port:
+            self.serve(int(port))
+        path = os.environ.get('FRUIT_METRICS_DUMP')
+        if path:
+            self.dump_every(path, float(os.environ.get('FRUIT_METRICS_INTERVAL', 10)))
+        return self.enabled
+
+    def stop(self):
+        if self._dump_thread is not None:
+            self._dump_stop.set()
+            self._dump_thread.join(timeout=2)
+            self._dump_thread = None
+            self.dump(self._dump_path)  # Final numbers on shutdown
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        self.profiler.stop()
+
+
+metrics = Metrics()
@@ -0,0 +1,346 @@
+"""
+Indexed nutrition catalog: class name -> nutrition record without loading the
+whole dataset.
+
+The source dump (nutrition_data.json, or a .jsonl / .csv export of a full
+food-composition table) is converted once into nutrition.db, a compact SQLite
+index that is then opened read-only and memory-mapped. Startup cost and memory
+stay flat however large the catalog gets; the index is rebuilt automatically
+when the source file changes.
+
+Lookups try, in order: the exact name, synonyms, the singular form, a
+trigram fuzzy match, and finally the trailing words of a longer name
+("Pomegranates", "bannana", "granny-smith apple" -> apple). Resolved names
+(and misses) are kept in an LRU cache.
+
+    python nutrition.py build [--source nutrition_data.json]
+    python nutrition.py lookup bannana
+    python nutrition.py prefix gran
+
+Source formats:
+    .json   {"apple": {"calories": 52, ..., "synonyms": ["malus"]}, ...}
+    .jsonl  one {"name": ..., "synonyms": [...], ...} object per line
+    .csv    a "name" column, optional "synonyms" column separated by ";"
+"""
+import argparse
+import csv
+import difflib
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+SOURCE_PATH = 'nutrition_data.json'
+INDEX_PATH = 'nutrition.db'
+MMAP_BYTES = 256 * 1024 * 1024
+SYNONYM_KEYS = ('synonyms', 'aliases')
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE foods (id INTEGER PRIMARY KEY, name TEXT NOT NULL, record TEXT NOT NULL);
+CREATE TABLE names (id INTEGER PRIMARY KEY, key TEXT NOT NULL, food INTEGER NOT NULL, synonym INTEGER NOT NULL);
+CREATE TABLE grams (gram TEXT NOT NULL, name INTEGER NOT NULL, PRIMARY KEY (gram, name)) WITHOUT ROWID;
+CREATE TEMP TABLE staged_grams (gram TEXT NOT NULL, name INTEGER NOT NULL);
+CREATE TABLE gram_df (gram TEXT PRIMARY KEY, n INTEGER NOT NULL) WITHOUT ROWID;
+"""
+
+
+def normalize(name):
+    """'Granny-Smith  Apple' -> 'granny smith apple'"""
+    return ' '.join(re.sub(r'[_\-,/()]+', ' ', str(name).lower()).split())
+
+
+def _singular(key):
+    if key.endswith('ies') and len(key) > 4:
+        return key[:-3] + 'y'  # berries -> berry
+    if key.endswith(('ches', 'shes', 'oes', 'sses', 'xes')):
+        return key[:-2]        # peaches, mangoes
+    if key.endswith('s') and not key.endswith('ss') and len(key) > 3:
+        return key[:-1]
+    return key
+
+
+def _grams(key):
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+
+def _readonly_uri(path):
+    return 'file:' + os.path.abspath(path).replace('?', '%3f').replace('#', '%23') + '?mode=ro'
+
+
+def _read_source(path):
+    """Yields (name, synonyms, record) from a JSON, JSON Lines or CSV dump."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.jsonl':
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    yield item.pop('name'), _pop_synonyms(item), item
+    elif ext == '.csv':
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                name = row.pop('name')
+                synonyms = [s for s in (row.pop('synonyms', '') or '').split(';') if s.strip()]
+                yield name, synonyms, {k: _number(v) for k, v in row.items() if v not in (None, '')}
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for name, item in data.items():
+            item = dict(item)
+            yield name, _pop_synonyms(item), item
+
+
+def _pop_synonyms(item):
+    synonyms = []
+    for key in SYNONYM_KEYS:
+        value = item.pop(key, None) or []
+        synonyms += value.split(';') if isinstance(value, str) else value
+    return synonyms
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def build_index(source=SOURCE_PATH, index_path=INDEX_PATH):
+    """Builds the index next to `index_path` and swaps it in atomically. Returns the number of foods."""
+    t0 = time.perf_counter()
+    tmp = f'{index_path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.executescript(SCHEMA)
+        foods = 0
+        keys = {}
+        with conn:
+            for food_id, (name, synonyms, record) in enumerate(_read_source(source)):
+                conn.execute("INSERT INTO foods VALUES (?, ?, ?)", (food_id, name, json.dumps(record)))
+                foods += 1
+                # First food claiming a name wins; a real name beats another food's synonym
+                key = normalize(name)
+                if key and keys.get(key, (None, 1))[1]:
+                    keys[key] = (food_id, 0)
+                for synonym in synonyms:
+                    keys.setdefault(normalize(synonym), (food_id, 1))
+            keys.pop('', None)
+            conn.executemany("INSERT INTO names VALUES (?, ?, ?, ?)",
+                             ((i, k, f, s) for i, (k, (f, s)) in enumerate(keys.items())))
+            df = {}
+            rows = []
+            for name_id, key in enumerate(keys):
+                for gram in _grams(key):
+                    rows.append((gram, name_id))
+                    df[gram] = df.get(gram, 0) + 1
+                if len(rows) > 100000:
+                    conn.executemany("INSERT INTO staged_grams VALUES (?, ?)", rows)
+                    rows = []
+            conn.executemany("INSERT INTO staged_grams VALUES (?, ?)", rows)
+            conn.executemany("INSERT INTO gram_df VALUES (?, ?)", df.items())
+            # Sorted in one go after the bulk insert (much faster than random B-tree inserts),
+            # the posting lists are then clustered by gram without a second copy as an index
+            conn.execute("CREATE UNIQUE INDEX names_key ON names (key)")
+            conn.execute("INSERT INTO grams SELECT gram, name FROM staged_grams ORDER BY gram, name")
+            conn.execute("DROP TABLE staged_grams")
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('source', os.path.abspath(source)), ('stamp', _source_stamp(source)),
+                ('foods', str(foods)), ('built', str(time.time()))
+            ])
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp, index_path)
+    print(f"Indexed {foods} foods ({len(keys)} names) into {index_path} in {time.perf_counter() - t0:.1f}s")
+    return foods
+
+
+class NutritionCatalog:
+    """
+    Read-only, case-insensitive lookups of nutrition records by (class) name.
+
+    get() is what the Detector uses; prefix() and fuzzy() return candidate
+    names for search boxes and tooling. The SQLite connection is shared
+    between threads behind a lock, like FruitStore.
+    """
+    def __init__(self, source=SOURCE_PATH, index_path=INDEX_PATH, cache_size=1024, fuzzy_cutoff=0.8):
+        self.source = source
+        self.index_path = index_path
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._lock = threading.RLock()
+        self._conn = None
+        # Caches (catalog name, record JSON text): every get() parses its own copy, callers can't alter the cache
+        self._record = functools.lru_cache(maxsize=cache_size)(self._resolve)
+        self.open()
+
+    def open(self):
+        with self._lock:
+            self.close()
+            if os.path.exists(self.source) and not self._fresh():
+                build_index(self.source, self.index_path)
+            if not os.path.exists(self.index_path):
+                return  # No catalog at all: every lookup is a miss
+            # Read-only + mmap: pages come straight from the OS cache, nothing is loaded up front
+            self._conn = sqlite3.connect(_readonly_uri(self.index_path), uri=True, check_same_thread=False)
+            self._conn.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+            self._conn.execute("PRAGMA query_only=ON")
+
+    def _fresh(self):
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            conn = sqlite3.connect(_readonly_uri(self.index_path), uri=True)
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError:
+            return False  # Half-written or from an older layout
+        return row is not None and row[0] == _source_stamp(self.source)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._record.cache_clear()
+
+    def __len__(self):
+        with self._lock:
+            if self._conn is None:
+                return 0
+            return self._conn.execute("SELECT COUNT(*) FROM foods").fetchone()[0]
+
+    def __contains__(self, name):
+        return self._record(name) is not None
+
+    def get(self, name):
+        """Nutrition record for `name` as a new dict, or None."""
+        found = self._record(name)
+        return json.loads(found[1]) if found is not None else None
+
+    def resolve(self, name):
+        """Catalog name `name` resolves to ('apples' -> 'apple', synonyms, typos), or None."""
+        found = self._record(name)
+        return found[0] if found is not None else None
+
+    def _resolve(self, name):
+        """(catalog name, record JSON) for `name` (exact, synonym, singular, fuzzy, then trailing words), or None."""
+        key = normalize(name)
+        if not key:
+            return None
+        food = self._exact(key)
+        if food is None:
+            matches = self.fuzzy(key, limit=1)
+            if matches:
+                food = self._food_id(matches[0][0])
+        if food is None:
+            # 'granny smith apple' -> 'smith apple' -> 'apple': the head noun comes last
+            words = key.split()
+            for i in range(1, len(words)):
+                food = self._exact(' '.join(words[i:]))
+                if food is not None:
+                    break
+        if food is None:
+            return None
+        with self._lock:
+            if self._conn is None:
+                return None  # Closed since the name was looked up
+            row = self._conn.execute("SELECT name, record FROM foods WHERE id = ?", (food,)).fetchone()
+        return tuple(row) if row else None
+
+    def _exact(self, key):
+        food = self._food_id(key)
+        if food is None and _singular(key) != key:
+            food = self._food_id(_singular(key))
+        return food
+
+    def _food_id(self, key):
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._conn.execute("SELECT food FROM names WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def prefix(self, text, limit=10):
+        """Names (and synonyms) starting with `text`, in order, from a range scan of the name index."""
+        key = normalize(text)
+        with self._lock:
+            if self._conn is None or not key:
+                return []
+            # Every key starting with `key` sorts between key and key + U+FFFF
+            rows = self._conn.execute(
+                "SELECT key FROM names WHERE key >= ? AND key < ? ORDER BY key LIMIT ?",
+                (key, key + '\uffff', limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def fuzzy(self, text, limit=5, cutoff=None, max_grams=12, candidates=50):
+        """[(name, score)] of the closest names by trigram overlap, re-ranked with difflib."""
+        key = normalize(text)
+        cutoff = self.fuzzy_cutoff if cutoff is None else cutoff
+        grams = sorted(_grams(key))
+        with self._lock:
+            if self._conn is None or not key:
+                return []
+            # The rarest grams are the most telling and have the shortest posting lists
+            df = self._conn.execute(
+                f"SELECT gram FROM gram_df WHERE gram IN ({','.join('?' * len(grams))}) ORDER BY n LIMIT ?",
+                (*grams, max_grams)
+            ).fetchall()
+            if not df:
+                return []
+            rare = [row[0] for row in df]
+            rows = self._conn.execute(
+                f"SELECT key FROM names WHERE id IN (SELECT name FROM grams WHERE gram IN "
+                f"({','.join('?' * len(rare))}) GROUP BY name ORDER BY COUNT(*) DESC LIMIT ?)",
+                (*rare, candidates)
+            ).fetchall()
+        scored = [(row[0], difflib.SequenceMatcher(None, key, row[0]).ratio()) for row in rows]
+        scored = [(name, score) for name, score in scored if score >= cutoff]
+        return sorted(scored, key=lambda s: -s[1])[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexed nutrition catalog")
+    parser.add_argument('command', choices=['build', 'lookup', 'prefix', 'fuzzy'])
+    parser.add_argument('name', nargs='?', default='')
+    parser.add_argument('--source', default=SOURCE_PATH)
+    parser.add_argument('--index', default=INDEX_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.source, args.index)
+        return
+    catalog = NutritionCatalog(args.source, args.index)
+    t0 = time.perf_counter()
+    if args.command == 'lookup':
+        result = catalog.get(args.name)
+    elif args.command == 'prefix':
+        result = catalog.prefix(args.name)
+    else:
+        result = catalog.fuzzy(args.name)
+    print(json.dumps(result, indent=2))
+    print(f"{(time.perf_counter() - t0) * 1e6:.0f} us")
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
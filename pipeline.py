@@ -0,0 +1,149 @@
+import threading
+import collections
+import time
+import cv2
+from utils import startup_report
+from metrics import metrics
+
+
+class LatestQueue:
+    """
+    Small bounded queue that drops the OLDEST item when full.
+    Used between pipeline stages so a slow consumer always sees the newest frame
+    and a fast producer never blocks on it.
+    """
+    def __init__(self, maxsize=1):
+        self._items = collections.deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)  # deque(maxlen) discards the oldest entry
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        # Blocks until an item is available (or timeout), returns None on timeout
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def get_nowait(self):
+        with self._cond:
+            return self._items.popleft() if self._items else None
+
+    def __len__(self):
+        return len(self._items)
+
+
+class FramePipeline:
+    """
+    Capture -> inference -> render pipeline.
+
+    A capture thread reads the camera, an inference worker runs the detector
+    (and the TrackCache, if given) and the GUI (render stage, Tk main thread)
+    polls `get_result()` for the newest annotated frame. Stages are linked by
+    drop-oldest queues so the camera never waits on YOLO and the display never
+    falls behind.
+    """
+    def __init__(self, detector, source=0, flip=True, queue_size=1, scheduler=None, tracks=None, recognize=True):
+        self.detector = detector
+        # Optional InferenceScheduler deciding when the detector really has to run
+        self.infer = scheduler.process if scheduler is not None else detector.detect_and_track
+        # Optional TrackCache, updated right after inference; recognize is read per frame (see TrackCache.update)
+        self.tracks = tracks
+        self.recognize = recognize
+        self.source = source
+        self.flip = flip
+
+        self.frames = LatestQueue(queue_size)   # capture -> inference
+        self.results = LatestQueue(queue_size)  # inference -> render
+
+        self.cap = None
+        self._latencies = collections.deque(maxlen=30)  # Seconds per frame, see frame_latency()
+        self._first_frame = False
+        self._stop = threading.Event()
+        self._threads = []
+
+        # Read only when metrics are scraped, nothing is added to the loops for these
+        metrics.register('capture_queue_depth', lambda: len(self.frames))
+        metrics.register('result_queue_depth', lambda: len(self.results))
+        metrics.register('frames_dropped_total', lambda: self.frames.dropped, kind='counter',
+                         help="Camera frames replaced before inference got to them")
+        metrics.register('results_dropped_total', lambda: self.results.dropped, kind='counter',
+                         help="Results replaced before the GUI rendered them")
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name="capture", daemon=True),
+            threading.Thread(target=self._inference_loop, name="inference", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=2)
+        self._threads = []
+
+    def frame_latency(self, q=0.9):
+        """Recent per-frame inference latency (q-quantile, seconds), None before the first frames."""
+        recent = sorted(self._latencies)
+        if len(recent) < 5:
+            return None
+        return recent[min(len(recent) - 1, int(q * len(recent)))]
+
+    def get_result(self):
+        # Called from the render stage: returns (frame, detections, track states) or None if nothing new.
+        # Track states are None without a TrackCache
+        return self.results.get_nowait()
+
+    def _capture_loop(self):
+        # Opening the camera can take seconds (esp. on Windows), keep it off the Tk thread
+        with startup_report.measure('camera_open'):
+            self.cap = cv2.VideoCapture(self.source)
+        try:
+            while not self._stop.is_set():
+                with metrics.timer('capture'):
+                    ret, frame = self.cap.read()
+                if not ret:
+                    metrics.inc('capture_failures_total')
+                    # Camera hiccup or end of stream, don't spin at 100% CPU
+                    self._stop.wait(0.01)
+                    continue
+                if self.flip:
+                    frame = cv2.flip(frame, 1)
+                self.frames.put(frame)
+        finally:
+            self.cap.release()
+            self.cap = None
+
+    def _inference_loop(self):
+        while not self._stop.is_set():
+            frame = self.frames.get(timeout=0.1)
+            if frame is None:
+                continue
+            ready = self.detector.ready.is_set()
+            t0 = time.perf_counter()
+            try:
+                with metrics.timer('frame'):
+                    detections = self.infer(frame)
+                states = self.tracks.update(frame, detections, self.recognize) if self.tracks is not None else None
+            except Exception as e:
+                print(f"Inference error: {e}")
+                metrics.inc('inference_errors_total')
+                continue
+            self._latencies.append(time.perf_counter() - t0)
+            if ready and not self._first_frame:
+                # First camera frame that went through the loaded model
+                startup_report.mark('first_frame')
+                self._first_frame = True
+            self.results.put((frame, detections, states))
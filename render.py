@@ -0,0 +1,109 @@
+import time
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+from metrics import metrics
+
+
+class FrameRenderer:
+    """
+    Draws frames into a Tk label with as little work per frame as possible.
+
+    The frame is first scaled down to the space available for the video, boxes
+    are drawn on that small copy, and the result is pasted into one PhotoImage
+    that is reused as long as the size doesn't change (no new image objects
+    and no label.configure per frame). Redraws are capped at `max_fps`.
+    """
+    def __init__(self, label, size_fn=None, max_fps=60):
+        self.label = label
+        # Returns the (width, height) available for the video, defaults to the frame size
+        self.size_fn = size_fn
+        self.min_interval = 1.0 / max_fps
+        self._last_render = 0.0
+        self._size = None
+        self._bgr = None
+        self._rgb = None
+        self._photo = None
+
+    def _target_size(self, frame):
+        h, w = frame.shape[:2]
+        if self.size_fn is None:
+            return w, h
+        max_w, max_h = self.size_fn()
+        if max_w <= 1 or max_h <= 1:
+            return w, h  # Widget not laid out yet
+        # Only ever scale down, keeping the aspect ratio
+        scale = min(1.0, max_w / w, max_h / h)
+        return max(1, int(w * scale)), max(1, int(h * scale))
+
+    def render(self, frame, boxes=()):
+        """
+        boxes: iterable of ((x1, y1, x2, y2), text, bgr_color) in frame coordinates.
+        Returns False if the frame was skipped because of the refresh-rate cap.
+        """
+        now = time.perf_counter()
+        if now - self._last_render < self.min_interval:
+            return False
+        self._last_render = now
+        with metrics.timer('render'):
+            self._draw(frame, boxes)
+        return True
+
+    def _draw(self, frame, boxes):
+        w, h = self._target_size(frame)
+        if self._size != (w, h):
+            # (Re)allocate the buffers and the Tk image only when the size changes
+            self._size = (w, h)
+            self._bgr = np.empty((h, w, 3), np.uint8)
+            self._rgb = np.empty((h, w, 3), np.uint8)
+            self._photo = self._new_photo(w, h)
+
+        fh, fw = frame.shape[:2]
+        if (fw, fh) == (w, h):
+            np.copyto(self._bgr, frame)
+        else:
+            cv2.resize(frame, (w, h), dst=self._bgr, interpolation=cv2.INTER_AREA)
+
+        sx, sy = w / fw, h / fh
+        for (x1, y1, x2, y2), text, color in boxes:
+            p1 = (int(x1 * sx), int(y1 * sy))
+            cv2.rectangle(self._bgr, p1, (int(x2 * sx), int(y2 * sy)), color, 2)
+            if text:
+                cv2.putText(self._bgr, text, (p1[0], p1[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+
+        cv2.cvtColor(self._bgr, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        # fromarray wraps the buffer without copying; paste updates the existing Tk image in place
+        self._photo.paste(Image.fromarray(self._rgb))
+
+    def _new_photo(self, w, h):
+        # Tk image shown by the label from now on (the benchmark swaps in a plain PIL image when headless)
+        photo = ImageTk.PhotoImage('RGB', (w, h))
+        self.label.imgtk = photo
+        self.label.configure(image=photo)
+        return photo
+
+
+class PanelUpdater:
+    """
+    Only touches a widget when what it shows actually changes.
+    Call reset() after widgets are destroyed and rebuilt (e.g. on a mode switch).
+    """
+    def __init__(self):
+        self._last = {}
+
+    def reset(self):
+        self._last.clear()
+
+    def configure(self, widget, **kwargs):
+        key = str(widget)
+        if self._last.get(key) != kwargs:
+            widget.configure(**kwargs)
+            self._last[key] = kwargs
+
+    def set_text(self, textbox, text):
+        # CTkTextbox: replace the whole content, but only if it differs
+        key = str(textbox)
+        if self._last.get(key) != text:
+            textbox.delete("0.0", "end")
+            textbox.insert("0.0", text)
+            self._last[key] = text
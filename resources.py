@@ -0,0 +1,245 @@
+"""
+CPU partitioning between a background training run and live recognition.
+
+While train.py runs next to the camera loop both would happily use every core.
+`TrainingBudget` splits the machine instead: live inference keeps its thread
+budget on a set of reserved cores, the trainer is pinned to the others, gets
+fewer threads/dataloader workers and runs at low priority. `TrainingGovernor`
+then watches the live frame latency and throttles (or pauses) the trainer
+whenever the live loop goes over its target.
+
+    FRUIT_LIVE_CORES=4        cores reserved for live inference (default: half)
+    FRUIT_LIVE_TARGET_MS=80   frame latency target (default: 1.5x the latency before training)
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from metrics import metrics
+
+
+def _parse_cores(text):
+    """'0-3,6' -> [0, 1, 2, 3, 6]"""
+    cores = []
+    for part in filter(None, text.split(',')):
+        lo, _, hi = part.partition('-')
+        cores.extend(range(int(lo), int(hi or lo) + 1))
+    return cores
+
+
+def _format_cores(cores):
+    return ','.join(str(c) for c in cores)
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def set_affinity(pid, cores):
+    """Pins a process (0 = this one) to `cores`. Returns False where the OS or psutil can't."""
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            if pid == 0:
+                # On Linux this only moves the calling thread, set every thread that already exists
+                for tid in os.listdir('/proc/self/task'):
+                    os.sched_setaffinity(int(tid), cores)
+            else:
+                os.sched_setaffinity(pid, cores)
+            return True
+        import psutil  # Windows (macOS has no affinity API at all)
+        psutil.Process(pid or os.getpid()).cpu_affinity(list(cores))
+        return True
+    except (ImportError, AttributeError, OSError, ValueError):
+        return False
+
+
+def set_torch_threads(n):
+    """Limits intra-op threads of an already loaded torch, never imports it. Returns the old value."""
+    torch = sys.modules.get('torch')
+    if torch is None:
+        return None
+    old = torch.get_num_threads()
+    torch.set_num_threads(max(1, n))
+    return old
+
+
+class TrainingBudget:
+    """
+    How the cores are split while a training run is in progress.
+
+    With fewer than 3 cores there is nothing to split: both sides share the
+    machine and only the trainer's priority and the governor keep the live
+    loop responsive.
+    """
+    def __init__(self, live_cores=None, cores=None):
+        cores = cores or available_cores()
+        if live_cores is None:
+            live_cores = int(os.environ.get('FRUIT_LIVE_CORES', 0)) or max(2, len(cores) // 2)
+        if len(cores) < 3:
+            self.live, self.train = cores, cores
+        else:
+            live_cores = min(max(1, live_cores), len(cores) - 1)
+            # Live inference gets the first cores, the trainer the rest
+            self.live, self.train = cores[:live_cores], cores[live_cores:]
+        self.train_threads = len(self.train)
+        self.train_workers = max(0, min(2, len(self.train) - 1))  # Dataloader processes
+        self._live_threads = None
+        self._live_affinity = None
+
+    def __repr__(self):
+        return (f"TrainingBudget(live={_format_cores(self.live)}, train={_format_cores(self.train)}, "
+                f"train_threads={self.train_threads}, workers={self.train_workers})")
+
+    def command_args(self):
+        """train.py flags applying the trainer's side of the budget (see `apply_training_budget`)."""
+        return ['--cores', _format_cores(self.train), '--threads', str(self.train_threads),
+                '--workers', str(self.train_workers), '--nice', '10']
+
+    def env(self):
+        """Environment for the trainer: BLAS/OpenMP pools are sized before torch even starts."""
+        env = dict(os.environ)
+        for key in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            env[key] = str(self.train_threads)
+        return env
+
+    def popen_kwargs(self):
+        if os.name == 'nt':
+            return {'creationflags': subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+        # Own process group so the governor can stop the dataloader workers along with it
+        return {'start_new_session': True}
+
+    def apply_live(self):
+        """Live side: this process moves to the reserved cores and torch stops spreading over the rest."""
+        if self._live_affinity is None and self.live != self.train:
+            original = available_cores()
+            if set_affinity(0, self.live):
+                self._live_affinity = original
+            else:
+                print(f"Could not pin live inference to cores {_format_cores(self.live)}")
+        old = set_torch_threads(len(self.live))
+        if old is not None and self._live_threads is None:
+            self._live_threads = old
+
+    def restore_live(self):
+        """Gives the live process its original cores and thread count back."""
+        if self._live_affinity is not None:
+            set_affinity(0, self._live_affinity)
+            self._live_affinity = None
+        if self._live_threads is not None:
+            set_torch_threads(self._live_threads)
+            self._live_threads = None
+
+
+def apply_training_budget(cores=None, threads=None, nice=None):
+    """Trainer side, called by train.py before torch spawns its threads and workers."""
+    if cores and not set_affinity(0, _parse_cores(cores)):
+        print(f"Could not pin training to cores {cores}")
+    if nice and hasattr(os, 'nice'):
+        os.nice(nice)
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+
+class TrainingGovernor:
+    """
+    Throttles a training process so live frame latency stays under a target.
+
+    Every `period` seconds the trainer is allowed to run for `duty * period`
+    and is suspended for the rest. The duty cycle backs off by half whenever
+    the live latency is over target and creeps back up while it's comfortably
+    below, down to a full pause if even 10% is too much.
+    Suspending uses SIGSTOP/SIGCONT on the trainer's process group, or psutil
+    on Windows; without either the governor only reports.
+    """
+    def __init__(self, proc, latency_fn, target_ms=None, period=1.0, min_duty=0.1):
+        self.proc = proc
+        self.latency_fn = latency_fn  # Recent live frame latency in seconds, or None if unknown
+        self.period = period
+        self.min_duty = min_duty
+        self.duty = 1.0
+        self.paused_seconds = 0.0
+        self._suspended = False
+        self._stop = threading.Event()
+        self._thread = None
+
+        if target_ms is None and os.environ.get('FRUIT_LIVE_TARGET_MS'):
+            target_ms = float(os.environ['FRUIT_LIVE_TARGET_MS'])
+        if target_ms is None:
+            # Relative to how the live loop did before training took any CPU
+            baseline = latency_fn()
+            target_ms = max(50.0, 1.5 * baseline * 1000) if baseline else 100.0
+        self.target = target_ms / 1000
+
+        metrics.register('training_duty', lambda: self.duty,
+                         help="Share of time background training is allowed to run")
+        metrics.register('training_paused_seconds_total', lambda: self.paused_seconds, kind='counter')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="training-governor", daemon=True)
+        self._thread.start()
+        print(f"Training governor: live latency target {self.target * 1000:.0f} ms")
+        return self
+
+    def stop(self):
+        """Stops throttling and always leaves the trainer running (never suspended)."""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2 * self.period)
+        self._thread = None
+        self._resume()
+
+    def _run(self):
+        while not self._stop.is_set() and self.proc.poll() is None:
+            latency = self.latency_fn()
+            if latency is not None:
+                self._adjust(latency)
+            if self.duty >= 1.0:
+                self._stop.wait(self.period)
+                continue
+            self._resume()
+            self._stop.wait(self.period * self.duty)
+            if self._stop.is_set() or self.proc.poll() is not None:
+                break
+            t0 = time.perf_counter()
+            self._suspend()
+            self._stop.wait(self.period * (1 - self.duty))
+            self._resume()
+            self.paused_seconds += time.perf_counter() - t0
+        self._resume()
+
+    def _adjust(self, latency):
+        old = self.duty
+        if latency > self.target:
+            self.duty = self.duty / 2 if self.duty / 2 >= self.min_duty else 0.0
+        elif latency < 0.8 * self.target:
+            self.duty = min(1.0, max(self.duty, self.min_duty / 2) + 0.1)
+        if (old == 1.0) != (self.duty == 1.0) or (old == 0.0) != (self.duty == 0.0):
+            state = "paused" if self.duty == 0.0 else "full speed" if self.duty == 1.0 else "throttled"
+            print(f"Training {state} (live latency {latency * 1000:.0f} ms, target {self.target * 1000:.0f} ms)")
+
+    def _signal(self, sig, psutil_method):
+        try:
+            if os.name == 'nt':
+                import psutil
+                process = psutil.Process(self.proc.pid)
+                for p in process.children(recursive=True) + [process]:
+                    getattr(p, psutil_method)()
+            else:
+                os.killpg(self.proc.pid, sig)
+            return True
+        except Exception:
+            return False  # Trainer already gone, or no psutil on Windows
+
+    def _suspend(self):
+        if not self._suspended:
+            self._suspended = self._signal(getattr(signal, 'SIGSTOP', None), 'suspend')
+
+    def _resume(self):
+        if self._suspended:
+            self._signal(getattr(signal, 'SIGCONT', None), 'resume')
+            self._suspended = False
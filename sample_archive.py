@@ -0,0 +1,455 @@
+"""
+Sharded sample archive: captured crops appended to a few large shard files
+instead of thousands of small JPEGs.
+
+    sample_archive/
+        index.db          SQLite index: id, fruit, shard, offset, length, size, hash
+        shard-00000.bin   encoded JPEGs back to back (rolled over at shard_bytes)
+        shard-00001.bin
+
+Shards are only ever appended to and are read through mmap, so random access
+is a slice + cv2.imdecode. Enable it with FRUIT_SAMPLE_ARCHIVE=sample_archive:
+save_fruit_data then appends to the archive, and train.py builds the dataset
+and trains straight from it (see make_archive_trainer) without extracting files.
+
+    python sample_archive.py import data/          # move an existing data/ folder in
+    python sample_archive.py export out/ --fruit apple
+    python sample_archive.py compact               # reclaim space of removed samples
+"""
+import argparse
+import hashlib
+import io
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import cv2
+import numpy as np
+from PIL import Image
+
+ARCHIVE_DIR = 'sample_archive'
+SHARD_BYTES = 256 * 1024 * 1024
+IMAGE_EXTS = ('.jpg', '.png', '.jpeg')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fruit TEXT NOT NULL COLLATE NOCASE,
+    shard INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    hash TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_fruit ON samples (fruit);
+"""
+
+
+def _shard_path(root, shard):
+    return os.path.join(root, f'shard-{shard:05d}.bin')
+
+
+def sample_ref(root, sample_id):
+    """Path-like name of an archived sample (what the dataset lists and the catalog store)."""
+    return f'{root}/{sample_id:08d}.jpg'
+
+
+def ref_id(ref):
+    return int(os.path.splitext(os.path.basename(ref))[0])
+
+
+class ShardReader:
+    """
+    Read-only mmap access to the shard files.
+    Maps are opened lazily and dropped when pickled or after a fork, so one
+    reader can be handed to DataLoader worker processes.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._maps = {}
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        return {'root': self.root}
+
+    def __setstate__(self, state):
+        self.__init__(state['root'])
+
+    def read_bytes(self, shard, offset, length):
+        if self._pid != os.getpid():
+            self._maps, self._pid = {}, os.getpid()
+        mm = self._maps.get(shard)
+        if mm is None or offset + length > len(mm):
+            # First access, or the shard grew since it was mapped
+            if mm is not None:
+                self._release(mm)
+            with open(_shard_path(self.root, shard), 'rb') as f:
+                mm = self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm)[offset:offset + length]
+
+    def read(self, shard, offset, length):
+        return cv2.imdecode(np.frombuffer(self.read_bytes(shard, offset, length), np.uint8), cv2.IMREAD_COLOR)
+
+    @staticmethod
+    def _release(mm):
+        try:
+            mm.close()
+        except BufferError:
+            pass  # A caller still holds a slice, the map goes away with it
+
+    def close(self):
+        for mm in self._maps.values():
+            self._release(mm)
+        self._maps = {}
+
+
+class SampleArchive:
+    def __init__(self, root=ARCHIVE_DIR, shard_bytes=SHARD_BYTES):
+        self.root = root
+        self.shard_bytes = shard_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(root, 'index.db'), timeout=10, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self.reader = ShardReader(root)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        self.reader.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    def _current_shard(self):
+        row = self._conn.execute("SELECT MAX(shard) FROM samples").fetchone()
+        shard = row[0] or 0
+        path = _shard_path(self.root, shard)
+        if os.path.exists(path) and os.path.getsize(path) >= self.shard_bytes:
+            shard += 1
+        return shard
+
+    @staticmethod
+    def _encode(sample):
+        # Staged files and encoded bytes are stored as they are, arrays are encoded once
+        if isinstance(sample, (bytes, bytearray, memoryview)):
+            return bytes(sample)
+        if isinstance(sample, str):
+            with open(sample, 'rb') as f:
+                return f.read()
+        ok, buf = cv2.imencode('.jpg', sample)
+        if not ok:
+            raise ValueError("could not encode sample")
+        return buf.tobytes()
+
+    def add(self, fruit, samples):
+        """
+        Appends samples (file paths, encoded bytes or BGR arrays) for `fruit`.
+        Returns [(ref, hash, created)] in the same order, ready for FruitStore.save_fruit.
+        """
+        fruit = fruit.lower()  # One spelling per class, like FruitStore
+        records = []
+        for sample in samples:
+            data = self._encode(sample)
+            width, height = Image.open(io.BytesIO(data)).size  # Header only, no decode
+            records.append((data, width, height, hashlib.sha1(data).hexdigest()))
+        if not records:
+            return []
+
+        with self._lock:
+            shard = self._current_shard()
+            rows = []
+            path = _shard_path(self.root, shard)
+            f = open(path, 'ab')
+            try:
+                for data, width, height, digest in records:
+                    if f.tell() >= self.shard_bytes:
+                        f.close()
+                        shard += 1
+                        path = _shard_path(self.root, shard)
+                        f = open(path, 'ab')
+                    rows.append((shard, f.tell(), len(data), width, height, digest))
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+            # Bytes are on disk before the index points at them; a crash in between only leaves unused bytes
+            created = time.time()
+            result = []
+            with self._conn:
+                for shard, offset, length, width, height, digest in rows:
+                    cur = self._conn.execute(
+                        "INSERT INTO samples (fruit, shard, offset, length, width, height, hash, created) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (fruit, shard, offset, length, width, height, digest, created)
+                    )
+                    result.append((sample_ref(self.root, cur.lastrowid), digest, created))
+        return result
+
+    def entries(self, fruit=None):
+        with self._lock:
+            if fruit is None:
+                rows = self._conn.execute("SELECT * FROM samples ORDER BY id").fetchall()
+            else:
+                rows = self._conn.execute("SELECT * FROM samples WHERE fruit = ? ORDER BY id", (fruit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def fruits(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT fruit FROM samples ORDER BY fruit")]
+
+    def locate(self, ref):
+        with self._lock:
+            row = self._conn.execute("SELECT shard, offset, length FROM samples WHERE id = ?", (ref_id(ref),)).fetchone()
+        if row is None:
+            raise KeyError(ref)
+        return tuple(row)
+
+    def read_bytes(self, ref):
+        return self.reader.read_bytes(*self.locate(ref))
+
+    def read(self, ref):
+        return self.reader.read(*self.locate(ref))
+
+    def remove(self, refs):
+        # Only the index entries go; compact() gives the bytes back
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM samples WHERE id = ?", [(ref_id(r),) for r in refs])
+
+    def compact(self):
+        """
+        Rewrites the shards without the bytes of removed samples. Returns bytes reclaimed.
+
+        The live samples are copied into new, higher shard numbers and the index
+        is switched to them in one transaction before the old shards are deleted,
+        so a crash at any point leaves an index that points at existing bytes.
+        Shard numbers are never reused.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT id, shard, offset, length FROM samples ORDER BY id").fetchall()
+            old_shards = sorted(int(n[6:11]) for n in os.listdir(self.root) if n.startswith('shard-') and n.endswith('.bin'))
+            before = sum(os.path.getsize(_shard_path(self.root, s)) for s in old_shards)
+            if before == sum(row['length'] for row in rows):
+                return 0  # Nothing was removed (or left behind by a crash), nothing to rewrite
+
+            shard = (old_shards[-1] + 1) if old_shards else 0
+            new_shards = [shard]
+            moved = []
+            f = open(_shard_path(self.root, shard), 'wb')
+            try:
+                for row in rows:
+                    if f.tell() >= self.shard_bytes:
+                        f.close()
+                        shard += 1
+                        new_shards.append(shard)
+                        f = open(_shard_path(self.root, shard), 'wb')
+                    moved.append((shard, f.tell(), row['id']))
+                    f.write(self.reader.read_bytes(row['shard'], row['offset'], row['length']))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+            # Switch point: before this commit the old shards are in use, after it the new ones
+            with self._conn:
+                self._conn.executemany("UPDATE samples SET shard = ?, offset = ? WHERE id = ?", moved)
+            self.reader.close()
+            for s in old_shards:
+                os.remove(_shard_path(self.root, s))
+            after = sum(os.path.getsize(_shard_path(self.root, s)) for s in new_shards)
+        return before - after
+
+    def import_folder(self, data_dir='data', remove=False):
+        """Appends data/<fruit>/*.jpg to the archive (optionally deleting the files). Returns the count."""
+        total = 0
+        for fruit in sorted(os.listdir(data_dir)):
+            folder = os.path.join(data_dir, fruit)
+            if not os.path.isdir(folder):
+                continue
+            paths = [os.path.join(folder, n) for n in sorted(os.listdir(folder)) if n.lower().endswith(IMAGE_EXTS)]
+            for i in range(0, len(paths), 256):
+                chunk = paths[i:i + 256]
+                self.add(fruit, chunk)
+                if remove:
+                    for path in chunk:
+                        os.remove(path)
+            total += len(paths)
+            print(f"{fruit}: {len(paths)} samples")
+        return total
+
+    def export(self, out_dir, fruit=None):
+        for entry in self.entries(fruit):
+            folder = os.path.join(out_dir, entry['fruit'])
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, f"sample_{entry['id']:08d}.jpg"), 'wb') as f:
+                f.write(self.reader.read_bytes(entry['shard'], entry['offset'], entry['length']))
+
+
+# Archive root -> (ShardReader, index by sample id), see _install_archive_decoder
+_ARCHIVES = {}
+
+
+def _install_archive_decoder():
+    """
+    Routes ultralytics' image decode for archive refs to the shards.
+
+    BaseDataset.load_image (resizing, the mosaic buffer, RAM caching) stays
+    upstream; only the call that turns a path into pixels is wrapped, and any
+    path outside a registered archive goes to the original function.
+    """
+    from ultralytics.data import base
+    if getattr(base, '_archive_decoder', False):
+        return
+
+    def route(original):
+        def imread(filename, *args, **kwargs):
+            archive = _ARCHIVES.get(os.path.dirname(os.path.abspath(str(filename))))
+            if archive is None:
+                return original(filename, *args, **kwargs)
+            reader, index = archive
+            entry = index[ref_id(filename)]
+            return reader.read(entry['shard'], entry['offset'], entry['length'])
+        return imread
+
+    if hasattr(base, 'imread'):
+        base.imread = route(base.imread)
+    else:
+        # Older releases call cv2.imread directly from that module
+        class _Cv2(object):
+            imread = staticmethod(route(cv2.imread))
+
+            def __getattr__(self, name):
+                return getattr(cv2, name)
+        base.cv2 = _Cv2()
+    base._archive_decoder = True
+
+
+def make_archive_trainer():
+    """
+    Ultralytics DetectionTrainer whose datasets read images straight from the
+    archive. Used by train.py when data.yaml has an `archive` entry; the train
+    and val lists there contain sample refs instead of image files.
+    Built on demand so importing this module doesn't pull in torch.
+    """
+    from ultralytics.data import YOLODataset
+    from ultralytics.models.yolo.detect import DetectionTrainer
+    from ultralytics.utils import colorstr
+    try:
+        from ultralytics.utils.torch_utils import unwrap_model
+    except ImportError:  # Named de_parallel before 8.4
+        from ultralytics.utils.torch_utils import de_parallel as unwrap_model
+
+    class ArchiveDataset(YOLODataset):
+        def __init__(self, *args, archive=None, **kwargs):
+            # The whole index is loaded up front: no SQLite connection has to survive a fork into the workers
+            store = SampleArchive(archive)
+            self.index = {entry['id']: entry for entry in store.entries()}
+            store.close()
+            self.reader = ShardReader(archive)
+            self._register()
+            if kwargs.get('cache') == 'disk':
+                kwargs['cache'] = 'ram'  # No .npy files next to virtual image paths
+            super().__init__(*args, **kwargs)
+
+        def __setstate__(self, state):
+            # Spawned DataLoader workers (Windows, macOS) start without the decode hook
+            self.__dict__.update(state)
+            self._register()
+
+        def _register(self):
+            _install_archive_decoder()
+            _ARCHIVES[os.path.abspath(self.reader.root)] = (self.reader, self.index)
+
+        def get_img_files(self, img_path):
+            with open(img_path, 'r') as f:
+                refs = [line.strip() for line in f if line.strip()]
+            if self.fraction < 1:
+                refs = refs[:round(len(refs) * self.fraction)]
+            return refs
+
+        def get_labels(self):
+            class_ids = {name.lower(): i for i, name in self.data['names'].items()}
+            labels = []
+            for ref in self.im_files:
+                entry = self.index[ref_id(ref)]
+                labels.append({
+                    'im_file': ref,
+                    'shape': (entry['height'], entry['width']),
+                    # The captured crop is the object itself: one box covering the whole image
+                    'cls': np.array([[class_ids[entry['fruit'].lower()]]], dtype=np.float32),
+                    'bboxes': np.array([[0.5, 0.5, 1.0, 1.0]], dtype=np.float32),
+                    'segments': [],
+                    'keypoints': None,
+                    'normalized': True,
+                    'bbox_format': 'xywh'
+                })
+            return labels
+
+        def check_cache_ram(self, safety_margin=0.5):
+            # Estimate from the index instead of reading sample files from disk
+            import psutil  # Installed with ultralytics
+            need = 0
+            for ref in self.im_files:
+                entry = self.index[ref_id(ref)]
+                r = min(1.0, self.imgsz / max(entry['width'], entry['height']))
+                need += entry['width'] * entry['height'] * 3 * r * r
+            return need * (1 + safety_margin) < psutil.virtual_memory().available
+
+    class ArchiveTrainer(DetectionTrainer):
+        def build_dataset(self, img_path, mode='train', batch=None):
+            gs = max(int(unwrap_model(self.model).stride.max() if self.model else 0), 32)
+            cfg = self.args
+            return ArchiveDataset(
+                img_path=img_path,
+                imgsz=cfg.imgsz,
+                batch_size=batch,
+                augment=mode == 'train',
+                hyp=cfg,
+                rect=cfg.rect or mode == 'val',
+                cache=cfg.cache or None,
+                single_cls=cfg.single_cls or False,
+                stride=int(gs),
+                pad=0.0 if mode == 'train' else 0.5,
+                prefix=colorstr(f'{mode}: '),
+                task=cfg.task,
+                classes=cfg.classes,
+                data=self.data,
+                fraction=cfg.fraction if mode == 'train' else 1.0,
+                archive=self.data['archive']
+            )
+
+    return ArchiveTrainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the sharded sample archive")
+    parser.add_argument('command', choices=['import', 'export', 'compact', 'stats'])
+    parser.add_argument('folder', nargs='?', default='data', help="Source folder (import) or target folder (export)")
+    parser.add_argument('--archive', default=os.environ.get('FRUIT_SAMPLE_ARCHIVE') or ARCHIVE_DIR)
+    parser.add_argument('--fruit', help="Only this fruit (export)")
+    parser.add_argument('--remove', action='store_true', help="Delete the imported files")
+    args = parser.parse_args()
+
+    archive = SampleArchive(args.archive)
+    if args.command == 'import':
+        print(f"Imported {archive.import_folder(args.folder, remove=args.remove)} samples into {args.archive}")
+    elif args.command == 'export':
+        archive.export(args.folder, args.fruit)
+    elif args.command == 'compact':
+        print(f"Reclaimed {archive.compact() / 1e6:.1f} MB")
+    else:
+        for fruit in archive.fruits():
+            print(f"{fruit}: {len(archive.entries(fruit))} samples")
+    archive.close()
+
+
+if __name__ == "__main__":
+    main()
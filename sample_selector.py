@@ -0,0 +1,64 @@
+import collections
+import time
+import cv2
+import numpy as np
+
+
+def dhash(img, hash_size=8):
+    """64-bit difference hash: tiny grayscale thumbnail, 1 bit per horizontal gradient sign."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class SampleSelector:
+    """
+    Decides at capture time which crops are worth keeping.
+
+    A crop is dropped if it comes less than `min_interval` seconds after the
+    last kept one, or if its perceptual hash is within `max_distance` bits of
+    one of the last `history` kept crops (i.e. it's a near-duplicate).
+    """
+    def __init__(self, max_distance=6, min_interval=0.2, history=64):
+        self.max_distance = max_distance
+        self.min_interval = min_interval
+        self._hashes = collections.deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        self._hashes.clear()
+        self._last_kept = None
+        self.kept = 0
+        self.dropped_interval = 0
+        self.dropped_duplicate = 0
+
+    def consider(self, crop, now=None):
+        """Returns True if the crop should be kept."""
+        now = time.monotonic() if now is None else now
+        if self._last_kept is not None and now - self._last_kept < self.min_interval:
+            self.dropped_interval += 1
+            return False
+
+        h = dhash(crop)
+        if any(hamming(h, other) <= self.max_distance for other in self._hashes):
+            self.dropped_duplicate += 1
+            return False
+
+        self._hashes.append(h)
+        self._last_kept = now
+        self.kept += 1
+        return True
+
+    @property
+    def dropped(self):
+        return self.dropped_interval + self.dropped_duplicate
+
+    def report(self):
+        total = self.kept + self.dropped
+        return (f"Kept {self.kept}/{total} frames "
+                f"(dropped {self.dropped_duplicate} near-duplicates, {self.dropped_interval} too soon)")
@@ -0,0 +1,125 @@
+import os
+import queue
+import shutil
+import threading
+import time
+import cv2
+from metrics import metrics
+
+
+class SampleWriter:
+    """
+    Encodes and writes captured crops to a staging folder in the background.
+
+    Crops go through a bounded queue to a small pool of writer threads, so a
+    capture session never holds more than `max_pending` crops in memory.
+    When the queue is full, `submit` blocks (or returns False if called with
+    block=False). `take()` waits for pending writes and hands back the file
+    paths, which save_fruit_data then only has to move into data/<fruit>/.
+    """
+    def __init__(self, staging_dir='.capture_session', workers=2, max_pending=32, ext='.jpg'):
+        self.staging_dir = staging_dir
+        self.ext = ext
+        # Leftovers from a session that was never saved (e.g. the app crashed)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._paths = []
+        self._seq = 0
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._threads = [threading.Thread(target=self._worker, name=f"sample-writer-{i}", daemon=True)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+        metrics.register('sample_queue_depth', self._queue.qsize, help="Crops waiting to be written")
+        metrics.register('samples_dropped_total', lambda: self.dropped, kind='counter')
+        metrics.register('samples_failed_total', lambda: self.failed, kind='counter')
+
+    def submit(self, img, block=True, timeout=None):
+        """Queues a crop for writing. Returns False if the queue stayed full."""
+        with self._lock:
+            self._seq += 1
+            self.submitted += 1
+            path = os.path.join(self.staging_dir, f'sample_{int(time.time() * 1000)}_{self._seq}{self.ext}')
+        try:
+            # Copy so the crop doesn't keep the whole camera frame alive
+            self._queue.put((path, img.copy()), block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.submitted -= 1
+                self.dropped += 1
+            return False
+        return True
+
+    def progress(self):
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'written': self.written,
+                'pending': self.submitted - self.written - self.failed,
+                'dropped': self.dropped,
+                'failed': self.failed
+            }
+
+    def flush(self):
+        # Wait until every queued crop is on disk
+        self._queue.join()
+
+    def take(self):
+        """Flushes and returns the written sample paths, starting a new session."""
+        self.flush()
+        with self._lock:
+            paths, self._paths = self._paths, []
+            self.submitted = self.written = self.dropped = self.failed = 0
+        return paths
+
+    def discard(self):
+        # Throw away the current session's files
+        for path in self.take():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join(timeout=2)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, img = item
+                with metrics.timer('disk_write'):
+                    ok = cv2.imwrite(path, img)
+                with self._lock:
+                    if ok:
+                        self._paths.append(path)
+                        self.written += 1
+                    else:
+                        self.failed += 1
+            finally:
+                self._queue.task_done()
+
+
+def move_samples(paths, dest_dir):
+    """Moves staged sample files into dest_dir, returns the new paths."""
+    os.makedirs(dest_dir, exist_ok=True)
+    moved = []
+    for path in paths:
+        dst = os.path.join(dest_dir, os.path.basename(path))
+        try:
+            os.replace(path, dst)  # Same disk: just a rename, no data copied
+        except OSError:
+            shutil.move(path, dst)
+        moved.append(dst)
+    return moved
@@ -0,0 +1,125 @@
+import time
+import cv2
+import numpy as np
+from utils import Detections
+from metrics import metrics
+
+
+class InferenceScheduler:
+    """
+    Decides per frame how much work Detector.detect_and_track really needs.
+
+    - Static scene (mean frame difference below `motion_threshold`): reuse the
+      last detections, no inference at all.
+    - Otherwise YOLO runs only every `detect_every` frames; in between the last
+      boxes are moved with sparse optical flow (a few points per box).
+    - The inference size is stepped through `sizes` to keep the measured
+      detector latency inside `latency_budget_ms` (PyTorch backend only,
+      exported models have a fixed input size).
+    """
+    def __init__(self, detector, motion_threshold=2.0, detect_every=3, refresh_every=30,
+                 latency_budget_ms=80, sizes=(320, 416, 512, 640), flow_scale=0.5):
+        self.detector = detector
+        self.motion_threshold = motion_threshold
+        self.detect_every = detect_every
+        self.refresh_every = refresh_every
+        self.latency_budget = latency_budget_ms / 1000.0
+        self.sizes = sorted(sizes)
+        self.flow_scale = flow_scale
+
+        self._size_idx = self.sizes.index(detector.imgsz) if detector.imgsz in self.sizes else len(self.sizes) - 1
+        self._latency = None  # EMA of detector latency
+        self._since_resize = 0
+
+        self._last = None            # Detections of the previous frame
+        self._last_thumb = None      # Thumbnail of the last frame that was actually looked at
+        self._prev_gray = None       # Downscaled gray of the previous frame, for optical flow
+        self._since_detect = 0
+
+        self.stats = {'detected': 0, 'propagated': 0, 'skipped': 0}
+        for key in self.stats:
+            metrics.register(f'scheduler_{key}_total', lambda key=key: self.stats[key], kind='counter')
+        metrics.register('inference_imgsz', lambda: self.detector.imgsz)
+
+    def process(self, frame):
+        thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (80, 60), interpolation=cv2.INTER_AREA)
+        ready = self.detector.ready.is_set()
+
+        if ready and self._last is not None and self._since_detect < self.refresh_every:
+            motion = float(np.mean(cv2.absdiff(thumb, self._last_thumb)))
+            if motion < self.motion_threshold:
+                # Nothing moved: same answer as last time
+                self._since_detect += 1
+                self.stats['skipped'] += 1
+                return self._last
+
+        gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), None, fx=self.flow_scale, fy=self.flow_scale,
+                          interpolation=cv2.INTER_AREA)
+        if (ready and self._last is not None and self._prev_gray is not None
+                and self._since_detect < self.detect_every - 1):
+            with metrics.timer('propagate'):
+                detections = self._propagate(self._last, self._prev_gray, gray, frame.shape)
+            self._since_detect += 1
+            self.stats['propagated'] += 1
+        else:
+            detections = self._detect(frame)
+
+        self._last = detections if ready else None
+        self._last_thumb = thumb
+        self._prev_gray = gray
+        return detections
+
+    def _detect(self, frame):
+        t0 = time.perf_counter()
+        detections = self.detector.detect_and_track(frame)
+        if self.detector.ready.is_set():
+            self._adapt_size(time.perf_counter() - t0)
+        self._since_detect = 0
+        self.stats['detected'] += 1
+        return detections
+
+    def _adapt_size(self, seconds):
+        self._latency = seconds if self._latency is None else 0.8 * self._latency + 0.2 * seconds
+        self._since_resize += 1
+        if self.detector.backend != 'pytorch' or self._since_resize < 10:
+            return
+        idx = self._size_idx
+        if self._latency > self.latency_budget and idx > 0:
+            idx -= 1
+        elif self._latency < 0.6 * self.latency_budget and idx < len(self.sizes) - 1:
+            idx += 1
+        if idx != self._size_idx:
+            self._size_idx = idx
+            self._since_resize = 0
+            self.detector.imgsz = self.sizes[idx]
+            print(f"Inference size -> {self.sizes[idx]} (latency {self._latency * 1000:.0f} ms)")
+
+    def _propagate(self, detections, prev_gray, gray, shape):
+        # Shift every box by the median optical flow of a 3x3 grid of points inside it
+        if not detections:
+            return detections
+        s = self.flow_scale
+        boxes = detections.xyxy.astype(np.float32) * s
+        grid = np.linspace(0.25, 0.75, 3, dtype=np.float32)
+        gx, gy = np.meshgrid(grid, grid)
+        gx, gy = gx.ravel(), gy.ravel()
+        pts = np.stack([
+            boxes[:, None, 0] + gx[None] * (boxes[:, None, 2] - boxes[:, None, 0]),
+            boxes[:, None, 1] + gy[None] * (boxes[:, None, 3] - boxes[:, None, 1])
+        ], axis=2).reshape(-1, 1, 2)
+
+        new_pts, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, pts, None, winSize=(15, 15), maxLevel=2)
+        flow = (new_pts - pts).reshape(len(boxes), len(gx), 2)
+        ok = status.reshape(len(boxes), len(gx)).astype(bool)
+
+        shift = np.zeros((len(boxes), 2), np.float32)
+        for i in range(len(boxes)):
+            if ok[i].any():
+                shift[i] = np.median(flow[i][ok[i]], axis=0)
+        shift /= s
+
+        h, w = shape[:2]
+        xyxy = detections.xyxy + np.round(np.hstack([shift, shift])).astype(np.int32)
+        xyxy[:, [0, 2]] = np.clip(xyxy[:, [0, 2]], 0, w)
+        xyxy[:, [1, 3]] = np.clip(xyxy[:, [1, 3]], 0, h)
+        return Detections(xyxy, detections.cls, detections.conf, detections.ids, detections.is_fruit, detections.names)
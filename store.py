@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fruits (
+    name TEXT PRIMARY KEY COLLATE NOCASE,
+    condition TEXT,
+    samples_count INTEGER NOT NULL DEFAULT 0,
+    last_updated TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    path TEXT PRIMARY KEY,
+    fruit TEXT NOT NULL COLLATE NOCASE,
+    hash TEXT,
+    captured_at REAL,
+    split TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_fruit ON samples (fruit);
+CREATE INDEX IF NOT EXISTS samples_hash ON samples (hash);
+"""
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FruitStore(Mapping):
+    """
+    Embedded SQLite store (WAL mode) for added fruits and the per-sample catalog.
+
+    Every write is one atomic transaction, so the GUI and a training run can
+    use the same file at the same time. The object itself behaves like the
+    old `database.json` dict: a read-only, case-insensitive mapping of fruit
+    name -> {'condition', 'samples_count', 'last_updated'}, backed by the
+    primary-key index.
+    """
+    def __init__(self, path='fruits.db', json_path='database.json'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._writes = 0
+        if json_path:
+            self.migrate_json(json_path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Mapping interface (what the GUIs and Detector use) ---
+
+    def __getitem__(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT condition, samples_count, last_updated FROM fruits WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return dict(row)
+
+    def __contains__(self, name):
+        if not isinstance(name, str):
+            return False
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM fruits WHERE name = ?", (name,)).fetchone() is not None
+
+    def __iter__(self):
+        with self._lock:
+            names = [row[0] for row in self._conn.execute("SELECT name FROM fruits ORDER BY name")]
+        return iter(names)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM fruits").fetchone()[0]
+
+    def version(self):
+        """Changes whenever the fruits may have changed, in this process or another one."""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0], self._writes
+
+    # --- Writes ---
+
+    def save_fruit(self, name, condition, samples=()):
+        """
+        Upserts a fruit and adds its samples to the catalog in one transaction.
+        samples: iterable of (path, hash, captured_at).
+        """
+        name = name.lower()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO samples (path, fruit, hash, captured_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET fruit = excluded.fruit, hash = excluded.hash, "
+                "captured_at = excluded.captured_at",
+                [(path, name, digest, ts) for path, digest, ts in samples]
+            )
+            self._conn.execute(
+                "INSERT INTO fruits (name, condition, samples_count, last_updated) "
+                "VALUES (?, ?, (SELECT COUNT(*) FROM samples WHERE fruit = ?), ?) "
+                "ON CONFLICT(name) DO UPDATE SET condition = excluded.condition, "
+                "samples_count = excluded.samples_count, last_updated = excluded.last_updated",
+                (name, condition, name, time.ctime())
+            )
+            self._writes += 1
+
+    def sync_samples(self, rows, removed=()):
+        """
+        Records dataset preparation results in the catalog.
+        rows: iterable of (path, fruit, hash, captured_at, split); removed: paths that no longer exist.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO samples (path, fruit, hash, captured_at, split) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET hash = excluded.hash, split = excluded.split",
+                [(path, fruit.lower(), digest, ts, split) for path, fruit, digest, ts, split in rows]
+            )
+            self._conn.executemany("DELETE FROM samples WHERE path = ?", [(p,) for p in removed])
+            self._conn.execute(
+                "UPDATE fruits SET samples_count = (SELECT COUNT(*) FROM samples WHERE samples.fruit = fruits.name)"
+            )
+            self._writes += 1
+
+    def samples(self, fruit=None):
+        with self._lock:
+            if fruit is None:
+                rows = self._conn.execute("SELECT * FROM samples ORDER BY path").fetchall()
+            else:
+                rows = self._conn.execute("SELECT * FROM samples WHERE fruit = ? ORDER BY path", (fruit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_sample(self, digest):
+        # Indexed lookup by content hash, e.g. to spot a crop that was already saved
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM samples WHERE hash = ?", (digest,)).fetchone()
+        return dict(row) if row else None
+
+    def migrate_json(self, json_path):
+        """
+        One-time import of the old database.json (renamed to .migrated afterwards).
+        Several processes may start on it at once (batch workers): the SQLite
+        write lock lets one of them import it, the others find it gone.
+        """
+        if not os.path.exists(json_path):
+            return False
+        with self._lock, self._conn:
+            # Held until the file is renamed, across processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                with open(json_path, 'r') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                return False  # Migrated by another process while this one waited for the lock
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO fruits (name, condition, samples_count, last_updated) VALUES (?, ?, ?, ?)",
+                [(name.lower(), rec.get('condition'), rec.get('samples_count', 0), rec.get('last_updated'))
+                 for name, rec in data.items()]
+            )
+            self._writes += 1
+            os.replace(json_path, json_path + '.migrated')
+        print(f"Migrated {len(data)} fruits from {json_path} to {self.path}")
+        return True
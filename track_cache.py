@@ -0,0 +1,186 @@
+import cv2
+import numpy as np
+from metrics import metrics
+
+
+class TrackState:
+    """
+    What the GUIs show for one tracked object, kept across frames.
+
+    `name` / `is_fruit` are the smoothed class vote, unless the few-shot
+    registry matched the track (`match` = (fruit, condition, score)), which
+    takes precedence. `ripeness` and `match` are refreshed every few frames,
+    `record` (fruit db row), `condition` and `nutrition` are resolved only
+    when the class or the db changes.
+    """
+    __slots__ = ('id', 'bbox', 'conf', 'name', 'is_fruit', 'ripeness', 'match', 'record', 'condition', 'nutrition',
+                 '_votes', '_voted', '_fruit_classes', '_refresh_frame', '_signature', '_record_key', '_memo',
+                 'last_seen')
+
+    def __init__(self, track_id):
+        self.id = track_id
+        self.bbox = None
+        self.conf = 0.0
+        self.name = None
+        self.is_fruit = False
+        self.ripeness = None
+        self.match = None
+        self.record = None
+        self.condition = None
+        self.nutrition = None
+        self._votes = {}          # class name -> decayed confidence
+        self._voted = None        # Class winning the vote
+        self._fruit_classes = {}  # class name -> is_fruit
+        self._refresh_frame = None
+        self._signature = None
+        self._record_key = None
+        self._memo = {}
+        self.last_seen = 0
+
+    def memo(self, key, fn):
+        """fn(self) computed once and reused until the class or its db/nutrition record changes."""
+        if key not in self._memo:
+            self._memo[key] = fn(self)
+        return self._memo[key]
+
+    def snapshot(self):
+        """Copy handed to the GUI thread. Shares the memo dict, which TrackCache replaces instead of clearing."""
+        copy = TrackState.__new__(TrackState)
+        for slot in TrackState.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        return copy
+
+
+class TrackCache:
+    """
+    Per-track cache on top of ByteTrack ids.
+
+    update() turns a frame's Detections into TrackStates (same order) so the
+    side panel doesn't flicker between classes and doesn't redo the db lookup,
+    nutrition lookup and formatting every frame. It runs on the pipeline's
+    inference thread (few-shot embedding and ripeness stay off the Tk thread)
+    and returns snapshots, so the GUI never sees a state half way through an
+    update. Tracks not seen for `max_age` frames are evicted (ByteTrack drops
+    them after its 30 frame buffer too).
+    Detections without a track id (id -1) get a fresh, uncached state.
+    """
+    def __init__(self, detector, refresh_every=15, appearance_threshold=12.0, max_age=30, vote_decay=0.8):
+        self.detector = detector
+        self.refresh_every = refresh_every
+        self.appearance_threshold = appearance_threshold
+        self.max_age = max_age
+        self.vote_decay = vote_decay
+        self._tracks = {}
+        self._names = None
+        self._model_version = None
+        self._frame = 0
+
+        metrics.register('tracks_cached', lambda: len(self._tracks))
+
+    def reset(self):
+        self._tracks.clear()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def update(self, frame, detections, recognize=True):
+        """recognize=False skips ripeness and few-shot matching (e.g. while capturing samples)."""
+        self._frame += 1
+        # Names compared by value: ultralytics builds a new names dict on every access
+        names_changed = detections.names is not self._names and detections.names != self._names
+        if names_changed or self.detector.model_version != self._model_version:
+            # New model (even one with the same classes): its tracker's ids start over at 1,
+            # and class ids may mean something else
+            self._tracks.clear()
+            self._model_version = self.detector.model_version
+        self._names = detections.names
+        db_version = self.detector.db.version()
+
+        states = []
+        due = []
+        for i in range(len(detections)):
+            track_id = int(detections.ids[i])
+            if track_id < 0:
+                state = TrackState(track_id)
+            else:
+                state = self._tracks.get(track_id)
+                if state is None:
+                    state = self._tracks[track_id] = TrackState(track_id)
+            state.last_seen = self._frame
+            state.bbox = tuple(int(v) for v in detections.xyxy[i])
+            state.conf = float(detections.conf[i])
+            self._vote(state, detections.names[int(detections.cls[i])], state.conf, bool(detections.is_fruit[i]))
+            if recognize and self._refresh_due(state, frame):
+                due.append(i)
+            states.append(state)
+
+        if due:
+            # Tracks that are new, old enough or look different: few-shot match first (it can change
+            # the class), then ripeness for the fruits among them, each in one batch
+            # The detector's own fruit/non-fruit call for each box, not the one a past match implied
+            own_fruit = [states[i]._fruit_classes[states[i]._voted] for i in due]
+            for i, match in zip(due, self.detector.classify_boxes(frame, detections.xyxy[due], own_fruit)):
+                states[i].match = match
+                states[i]._refresh_frame = self._frame
+                self._apply_class(states[i])
+            fruits = [i for i in due if states[i].is_fruit]
+            if fruits:
+                with metrics.timer('ripeness'):
+                    values = self.detector.ripeness.evaluate(frame, detections.xyxy[fruits],
+                                                             [states[i].name for i in fruits])
+                for i, value in zip(fruits, values):
+                    states[i].ripeness = value
+
+        for state in states:
+            self._resolve_record(state, db_version)
+
+        # Evict tracks ByteTrack has given up on
+        for track_id in [t for t, s in self._tracks.items() if self._frame - s.last_seen > self.max_age]:
+            del self._tracks[track_id]
+        return [state.snapshot() for state in states]
+
+    def _vote(self, state, name, conf, is_fruit):
+        votes = state._votes
+        for key in votes:
+            votes[key] *= self.vote_decay
+        votes[name] = votes.get(name, 0.0) + conf
+        state._fruit_classes[name] = is_fruit
+        state._voted = max(votes, key=votes.get)
+        self._apply_class(state)
+
+    @staticmethod
+    def _apply_class(state):
+        if state.match is not None:
+            name, is_fruit = state.match[0], True
+        else:
+            # Refreshed every frame, a class becomes a fruit once it's added to the db
+            name, is_fruit = state._voted, state._fruit_classes[state._voted]
+        state.is_fruit = is_fruit
+        if name != state.name:
+            state.name = name
+            state._memo = {}
+
+    def _resolve_record(self, state, db_version):
+        match_condition = state.match[1] if state.match is not None else None
+        key = (state.name, match_condition, db_version)
+        if key == state._record_key:
+            return
+        state._record_key = key
+        state.record = self.detector.db.get(state.name.lower())
+        # The registry knows the condition of the closest samples, the db only the last one saved
+        state.condition = match_condition or (state.record['condition'] if state.record else None)
+        state.nutrition = self.detector.get_nutrition(state.name)
+        state._memo = {}
+
+    def _refresh_due(self, state, frame):
+        x1, y1, x2, y2 = state.bbox
+        crop = frame[max(y1, 0):y2, max(x1, 0):x2]
+        if crop.size == 0:
+            return False
+        # 4x4 colour thumbnail as a cheap "did it change" check (lighting, turned fruit, wrong box)
+        signature = cv2.resize(crop, (4, 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+        if (state._refresh_frame is None or self._frame - state._refresh_frame >= self.refresh_every
+                or float(np.mean(np.abs(signature - state._signature))) > self.appearance_threshold):
+            state._signature = signature
+            return True
+        return False
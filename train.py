@@ -1,51 +1,233 @@
 import os
 import yaml
-from ultralytics import YOLO
 import shutil
-from sklearn.model_selection import train_test_split
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from store import FruitStore, file_hash
+from sample_archive import SampleArchive
 
-def prepare_yolo_dataset(data_dir='data', output_dir='yolo_dataset'):
+TRAIN_IMGSZ = 416
+IMAGE_EXTS = ('.jpg', '.png', '.jpeg')
+MANIFEST_NAME = 'manifest.json'
+# Prefix of the structured progress lines printed during training
+PROGRESS_PREFIX = 'PROGRESS '
+
+
+def _load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return None
+
+
+def _save_manifest(output_dir, manifest):
+    # Write to a temp file first so an interrupted run never leaves a broken manifest
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _output_paths(output_dir, entry):
+    img = os.path.join(output_dir, entry['split'], 'images', entry['out'])
+    label = os.path.join(output_dir, entry['split'], 'labels', entry['out'].rsplit('.', 1)[0] + '.txt')
+    return img, label
+
+
+def _write_sample(src, output_dir, entry, imgsz):
+    """Writes the image and its label, returns False (nothing written) for an unreadable image."""
+    dst_img, dst_label = _output_paths(output_dir, entry)
+    _remove(dst_img)
+    if imgsz:
+        # Pre-resize once so the trainer doesn't decode full-size crops every epoch
+        img = cv2.imread(src)
+        if img is None:
+            print(f"Warning: skipping unreadable image {src}")
+            _remove(dst_label)
+            return False
+        h, w = img.shape[:2]
+        scale = imgsz / max(h, w)
+        if scale < 1:
+            img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(dst_img, img)
+    else:
+        try:
+            os.link(src, dst_img)  # No data copied at all when data/ and yolo_dataset/ share a disk
+        except OSError:
+            shutil.copy(src, dst_img)
+
+    # Create a "dummy" label (entire image as bounding box)
+    # Since we don't have bounding boxes from just raw images,
+    # we assume the captured sample is the object itself.
+    with open(dst_label, 'w') as f:
+        # class_id center_x center_y width height (normalized)
+        f.write(f"{entry['class_id']} 0.5 0.5 1.0 1.0\n")
+    return True
+
+
+def _hash_split(digest, val_ratio):
+    # Split decided by the content hash, so adding samples never reshuffles old ones
+    return 'val' if int(digest[:8], 16) % 1000 < val_ratio * 1000 else 'train'
+
+
+def _ensure_splits(samples, classes, class_of):
+    """Every class needs a training image, and one validation image once it has 2+ samples. Returns the moved keys."""
+    by_class = {}
+    for key in samples:
+        by_class.setdefault(class_of(key), []).append(key)
+    moved = []
+    for cls in classes:
+        keys = by_class.get(cls, [])
+        for split, needed in [('train', len(keys) >= 1), ('val', len(keys) >= 2)]:
+            if not needed or any(samples[k]['split'] == split for k in keys):
+                continue
+            key = min(keys, key=lambda k: samples[k]['hash'])
+            samples[key]['split'] = split
+            moved.append(key)
+    return moved
+
+
+def prepare_dataset_incremental(data_dir='data', output_dir='yolo_dataset', imgsz=None, workers=None, val_ratio=0.2):
     """
-    Converts collected images into YOLO format.
-    Assumes data_dir contains subfolders named after classes.
+    Incrementally converts collected images into YOLO format.
+
+    A manifest in output_dir remembers every sample's size/mtime, content hash,
+    split and class id. Unchanged samples are skipped, new or modified ones are
+    (hard)linked or pre-resized in a thread pool, and samples deleted from
+    data_dir are removed from the dataset.
+    Returns a dict of stats ('added', 'updated', 'removed', 'unchanged',
+    'changed_classes', 'pending_classes', 'classes'), or None if there is nothing to train on.
     """
     if not os.path.exists(data_dir):
         print("No data found to train on.")
-        return False
-        
-    classes = [d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d))]
-    if not classes:
+        return None
+
+    present = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    if not present:
         print("No classes found.")
-        return False
+        return None
+
+    manifest = _load_manifest(output_dir)
+    if manifest is None or manifest.get('imgsz') != imgsz:
+        # First run (or resize setting changed): start from a clean output folder
+        for split in ['train', 'val']:
+            shutil.rmtree(os.path.join(output_dir, split), ignore_errors=True)
+        manifest = {'imgsz': imgsz, 'classes': [], 'samples': {}}
 
     # Create YOLO structure
     for split in ['train', 'val']:
         os.makedirs(f'{output_dir}/{split}/images', exist_ok=True)
         os.makedirs(f'{output_dir}/{split}/labels', exist_ok=True)
 
+    # Keep existing class ids stable, append new classes at the end
+    classes = [c for c in manifest['classes'] if c in present]
+    classes += [c for c in present if c not in classes]
     class_map = {cls: i for i, cls in enumerate(classes)}
-    
+
+    old_samples = manifest['samples']
+    samples = {}
+    jobs = []
+    stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    changed_classes = set()
+    removed_classes = set()
+
     for cls in classes:
         cls_path = os.path.join(data_dir, cls)
-        images = [f for f in os.listdir(cls_path) if f.endswith(('.jpg', '.png', '.jpeg'))]
-        
-        if not images: continue
-        
-        train_imgs, val_imgs = train_test_split(images, test_size=0.2, random_state=42)
-        
-        for split, split_imgs in [('train', train_imgs), ('val', val_imgs)]:
-            for img_name in split_imgs:
-                src = os.path.join(cls_path, img_name)
-                dst_img = f'{output_dir}/{split}/images/{cls}_{img_name}'
-                shutil.copy(src, dst_img)
-                
-                # Create a "dummy" label (entire image as bounding box)
-                # Since we don't have bounding boxes from just raw images, 
-                # we assume the captured sample is the object itself.
-                dst_label = f'{output_dir}/{split}/labels/{cls}_{img_name.rsplit(".", 1)[0]}.txt'
-                with open(dst_label, 'w') as f:
-                    # class_id center_x center_y width height (normalized)
-                    f.write(f"{class_map[cls]} 0.5 0.5 1.0 1.0\n")
+        for img_name in sorted(os.listdir(cls_path)):
+            if not img_name.lower().endswith(IMAGE_EXTS):
+                continue
+            key = f'{cls}/{img_name}'
+            st = os.stat(os.path.join(cls_path, img_name))
+            old = old_samples.get(key)
+            entry = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'class_id': class_map[cls],
+                'out': f'{cls}_{img_name}',
+                'hash': None,
+                'split': None
+            }
+            if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+                entry['hash'] = old['hash']
+                entry['split'] = old['split']
+                if old['class_id'] == entry['class_id']:
+                    samples[key] = entry
+                    stats['unchanged'] += 1
+                    continue
+            samples[key] = entry
+            jobs.append((key, os.path.join(cls_path, img_name), old))
+            changed_classes.add(cls)
+
+    # Hash new/modified files in parallel
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = list(pool.map(lambda job: samples[job[0]]['hash'] or file_hash(job[1]), jobs))
+    for (key, _, old), digest in zip(jobs, hashes):
+        entry = samples[key]
+        entry['hash'] = digest
+        if entry['split'] is None:
+            entry['split'] = _hash_split(digest, val_ratio)
+        stats['updated' if old else 'added'] += 1
+
+    job_keys = {job[0] for job in jobs}
+    for key in _ensure_splits(samples, classes, lambda k: k.split('/', 1)[0]):
+        if key not in job_keys:
+            jobs.append((key, os.path.join(data_dir, key), old_samples.get(key)))
+            job_keys.add(key)
+            stats['unchanged'] -= 1
+            stats['updated'] += 1
+        changed_classes.add(key.split('/', 1)[0])
+
+    # Drop outputs of deleted samples and of samples that moved split
+    for key, old in old_samples.items():
+        if key not in samples or (key in job_keys and old['split'] != samples[key]['split']):
+            for path in _output_paths(output_dir, old):
+                _remove(path)
+            if key not in samples:
+                stats['removed'] += 1
+                changed_classes.add(key.split('/', 1)[0])
+                removed_classes.add(key.split('/', 1)[0])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        written = list(pool.map(lambda job: _write_sample(job[1], output_dir, samples[job[0]], imgsz), jobs))
+    written_classes = set()
+    skipped_classes = set()
+    for (key, _, old), ok in zip(jobs, written):
+        cls = key.split('/', 1)[0]
+        if ok:
+            written_classes.add(cls)
+            continue
+        # Left out of the manifest, so it is tried again once the file is replaced
+        del samples[key]
+        stats['updated' if old else 'added'] -= 1
+        stats['skipped'] = stats.get('skipped', 0) + 1
+        if old is None:
+            skipped_classes.add(cls)
+        else:
+            written_classes.add(cls)  # Its old output is gone, that is a change
+    # Nothing new to train on for a class whose only change is an unreadable new file
+    changed_classes -= skipped_classes - written_classes - removed_classes
+
+    # Classes changed since the last successful training run (cleared by mark_trained)
+    pending = sorted(c for c in set(manifest.get('pending', [])) | changed_classes if c in class_map)
+    manifest = {'imgsz': imgsz, 'classes': classes, 'samples': samples, 'pending': pending}
+    _save_manifest(output_dir, manifest)
+
+    # Keep the sample catalog in fruits.db in sync (hashes and train/val split)
+    store = FruitStore(json_path=None)
+    store.sync_samples(
+        [(f'{data_dir}/{key}', key.split('/', 1)[0], e['hash'], e['mtime'], e['split']) for key, e in samples.items()],
+        removed=[f'{data_dir}/{key}' for key in old_samples if key not in samples]
+    )
+    store.close()
 
     # Create data.yaml
     data_yaml = {
@@ -57,27 +239,234 @@ def prepare_yolo_dataset(data_dir='data', output_dir='yolo_dataset'):
     
     with open('data.yaml', 'w') as f:
         yaml.dump(data_yaml, f)
-        
-    return True
 
-def train_model():
+    stats['changed_classes'] = sorted(c for c in changed_classes if c in class_map)
+    stats['pending_classes'] = pending
+    stats['classes'] = classes
+    print(f"Dataset ready: {stats['added']} added, {stats['updated']} updated, "
+          f"{stats['removed']} removed, {stats['unchanged']} unchanged"
+          + (f", {stats['skipped']} unreadable skipped" if stats.get('skipped') else ""))
+    return stats
+
+
+def prepare_archive_dataset(archive_dir, output_dir='yolo_dataset', val_ratio=0.2):
+    """
+    Archive counterpart of prepare_dataset_incremental: nothing is extracted.
+    Only train/val lists of sample refs are written to output_dir and data.yaml
+    gets an `archive` entry, which makes train_model use the archive trainer.
+    Same manifest (stable class ids, hash splits, pending classes) and stats.
+    """
+    archive = SampleArchive(archive_dir)
+    rows = archive.entries()
+    archive.close()
+    if not rows:
+        print("No data found to train on.")
+        return None
+
+    archive_path = os.path.abspath(archive_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _load_manifest(output_dir)
+    if manifest is None or manifest.get('archive') != archive_path:
+        manifest = {'archive': archive_path, 'classes': [], 'samples': {}}
+
+    # Same case-insensitive names as FruitStore; archives written before add() lowercased may mix spellings
+    present = sorted({row['fruit'].lower() for row in rows})
+    classes = [c for c in manifest['classes'] if c in present]
+    classes += [c for c in present if c not in classes]
+    class_map = {cls: i for i, cls in enumerate(classes)}
+
+    old_samples = manifest['samples']
+    samples = {}
+    fruit_of = {}
+    stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    changed_classes = set()
+    for row in rows:
+        key = str(row['id'])
+        fruit = row['fruit'].lower()
+        fruit_of[key] = fruit
+        old = old_samples.get(key)
+        entry = {
+            'ref': f"{archive_dir}/{row['id']:08d}.jpg",
+            'class_id': class_map[fruit],
+            'hash': row['hash'],
+            'mtime': row['created'],
+            'split': old['split'] if old else _hash_split(row['hash'], val_ratio)
+        }
+        samples[key] = entry
+        if old and old['class_id'] == entry['class_id']:
+            stats['unchanged'] += 1
+        else:
+            stats['updated' if old else 'added'] += 1
+            changed_classes.add(fruit)
+
+    for key in _ensure_splits(samples, classes, fruit_of.get):
+        changed_classes.add(fruit_of[key])
+    for key, old in old_samples.items():
+        if key not in samples:
+            stats['removed'] += 1
+            changed_classes.add(classes[old['class_id']] if old['class_id'] < len(classes) else None)
+    changed_classes.discard(None)
+
+    lists = {}
+    for split in ['train', 'val']:
+        lists[split] = os.path.abspath(os.path.join(output_dir, f'archive_{split}.txt'))
+        with open(lists[split], 'w') as f:
+            f.write(''.join(e['ref'] + '\n' for e in samples.values() if e['split'] == split))
+
+    pending = sorted(c for c in set(manifest.get('pending', [])) | changed_classes if c in class_map)
+    _save_manifest(output_dir, {'archive': archive_path, 'classes': classes, 'samples': samples, 'pending': pending})
+
+    store = FruitStore(json_path=None)
+    store.sync_samples(
+        [(e['ref'], fruit_of[key], e['hash'], e['mtime'], e['split']) for key, e in samples.items()],
+        removed=[e['ref'] for key, e in old_samples.items() if key not in samples]
+    )
+    store.close()
+
+    data_yaml = {
+        'path': os.path.abspath(output_dir),
+        'train': lists['train'],
+        'val': lists['val'],
+        'names': {i: cls for i, cls in enumerate(classes)},
+        'archive': archive_path
+    }
+    with open('data.yaml', 'w') as f:
+        yaml.dump(data_yaml, f)
+
+    stats['changed_classes'] = sorted(c for c in changed_classes if c in class_map)
+    stats['pending_classes'] = pending
+    stats['classes'] = classes
+    print(f"Archive dataset ready: {stats['added']} added, {stats['updated']} updated, "
+          f"{stats['removed']} removed, {stats['unchanged']} unchanged")
+    return stats
+
+
+def prepare_yolo_dataset(data_dir='data', output_dir='yolo_dataset', imgsz=None, workers=None):
+    """
+    Converts collected images into YOLO format.
+    Assumes data_dir contains subfolders named after classes.
+    Only new, modified or deleted samples are processed (see prepare_dataset_incremental).
+    """
+    return prepare_dataset_incremental(data_dir, output_dir, imgsz, workers) is not None
+
+def mark_trained(output_dir='yolo_dataset'):
+    manifest = _load_manifest(output_dir)
+    if manifest is not None:
+        manifest['pending'] = []
+        _save_manifest(output_dir, manifest)
+
+
+def build_incremental_split(stats, output_dir='yolo_dataset', replay=0.3, seed=0):
+    """
+    Writes a training list with every train image of the changed classes plus
+    a `replay` share of the others (so the model doesn't forget them), and a
+    data yaml pointing at it. Validation still uses the full val split.
+    """
+    pending = set(stats['pending_classes'])
+    manifest = _load_manifest(output_dir)
+    new, old = [], []
+    for key, entry in manifest['samples'].items():
+        if entry['split'] != 'train':
+            continue
+        # Archive samples are listed by ref, folder samples by their file in the dataset
+        img = entry.get('ref') or os.path.abspath(_output_paths(output_dir, entry)[0])
+        (new if stats['classes'][entry['class_id']] in pending else old).append(img)
+
+    rng = random.Random(seed)
+    replayed = rng.sample(sorted(old), int(len(old) * replay))
+    list_path = os.path.join(output_dir, 'incremental_train.txt')
+    with open(list_path, 'w') as f:
+        f.write('\n'.join(sorted(new) + replayed) + '\n')
+
+    # Same as data.yaml (val split, names, archive) apart from the training list
+    with open('data.yaml', 'r') as f:
+        data_yaml = yaml.safe_load(f)
+    data_yaml['train'] = os.path.abspath(list_path)
+    with open('data_incremental.yaml', 'w') as f:
+        yaml.dump(data_yaml, f)
+    print(f"Incremental training set: {len(new)} new/changed + {len(replayed)} replayed images")
+    return 'data_incremental.yaml'
+
+
+def _progress_callbacks():
+    # One JSON line per epoch on stdout, read by the GUI while training runs
+    state = {}
+
+    def on_train_start(trainer):
+        state['start'] = time.time()
+        _emit({'event': 'start', 'epochs': trainer.epochs})
+
+    def on_fit_epoch_end(trainer):
+        done = trainer.epoch + 1
+        elapsed = time.time() - state.get('start', time.time())
+        _emit({
+            'event': 'epoch',
+            'epoch': done,
+            'epochs': trainer.epochs,
+            'eta_seconds': round(elapsed / done * (trainer.epochs - done), 1),
+            'metrics': {k: round(float(v), 4) for k, v in (trainer.metrics or {}).items()}
+        })
+
+    def on_train_end(trainer):
+        _emit({'event': 'end', 'seconds': round(time.time() - state.get('start', time.time()), 1)})
+
+    return {'on_train_start': on_train_start, 'on_fit_epoch_end': on_fit_epoch_end, 'on_train_end': on_train_end}
+
+
+def _emit(event):
+    print(PROGRESS_PREFIX + json.dumps(event), flush=True)
+
+
+def train_model(resize=False, incremental=False, replay=0.3, cache='ram', archive=None, workers=8):
+    # Imported here so the GUIs can import this module (PROGRESS_PREFIX) without loading torch
+    from ultralytics import YOLO
+
     print("Preparing dataset...")
-    if not prepare_yolo_dataset():
+    archive = archive or os.environ.get('FRUIT_SAMPLE_ARCHIVE')
+    if archive:
+        # Trains straight from the shards, images are decoded (and resized) in memory
+        from sample_archive import make_archive_trainer
+        stats = prepare_archive_dataset(archive)
+        trainer = make_archive_trainer()
+    else:
+        stats = prepare_dataset_incremental(imgsz=TRAIN_IMGSZ if resize else None)
+        trainer = None
+    if stats is None:
         return
-        
-    print("Starting fast-track training...")
+
+    data = 'data.yaml'
+    weights = 'yolov8n.pt'
+    epochs = 30             # Increased slightly for better accuracy with faster learning rate
+    if incremental and os.path.exists('best.pt'):
+        if not stats['pending_classes']:
+            print("Nothing changed since the last training, keeping best.pt")
+            return
+        # Warm start: continue from the current model and mostly look at what changed
+        print(f"Starting incremental training for: {', '.join(stats['pending_classes'])}")
+        data = build_incremental_split(stats, replay=replay)
+        weights = 'best.pt'
+        epochs = 10
+    else:
+        print("Starting fast-track training...")
+
     # Switching back to YOLOv8n (Nano) for much faster training
-    model = YOLO('yolov8n.pt')
+    model = YOLO(weights)
+    for event, callback in _progress_callbacks().items():
+        model.add_callback(event, callback)
     
     # Optimized training for CPU speed and high accuracy
     model.train(
-        data='data.yaml', 
-        epochs=30,             # Increased slightly for better accuracy with faster learning rate
-        imgsz=416,             # Reduced from 640 to 416 for significant CPU speedup
+        data=data, 
+        trainer=trainer,
+        epochs=epochs,
+        imgsz=TRAIN_IMGSZ,     # Reduced from 640 to 416 for significant CPU speedup
         batch=8,               # Optimized for CPU memory
         lr0=0.01,              # Increased initial learning rate for faster convergence
         project='fruit_runs', 
         name='custom_fruit',
+        exist_ok=True,         # Reuse the run folder instead of custom_fruit2, 3, ...
+        cache=cache or False,  # Decode images once instead of every epoch
+        workers=workers,       # Dataloader processes, fewer while the live app shares the CPU
         optimizer='AdamW',     # AdamW often converges faster on smaller datasets
         degrees=15,            # Rotation augmentation
         fliplr=0.5,            # Horizontal flip
@@ -86,12 +475,31 @@ def train_model():
     )
     
     # Move the best model to root
-    best_model = 'fruit_runs/custom_fruit/weights/best.pt'
+    best_model = str(model.trainer.best)
     if os.path.exists(best_model):
         shutil.copy(best_model, 'best.pt')
+        mark_trained()
         print("Training complete. High-accuracy model saved as 'best.pt'")
     else:
         print("Training failed or stopped early.")
 
 if __name__ == "__main__":
-    train_model()
+    import argparse
+    parser = argparse.ArgumentParser(description="Prepare the YOLO dataset and fine-tune the model")
+    parser.add_argument('--resize', action='store_true', help=f"Pre-resize dataset images to {TRAIN_IMGSZ}px")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Start from best.pt and train mostly on new/changed classes")
+    parser.add_argument('--replay', type=float, default=0.3, help="Share of unchanged training images replayed")
+    parser.add_argument('--cache', choices=['ram', 'disk', 'none'], default='ram', help="Dataset image cache")
+    parser.add_argument('--archive', help="Train from this sample archive (default: FRUIT_SAMPLE_ARCHIVE)")
+    # Resource budget, set by the GUI when training next to live recognition (resources.TrainingBudget)
+    parser.add_argument('--cores', help="Pin training to these cores, e.g. 4-7")
+    parser.add_argument('--threads', type=int, help="Torch threads for training")
+    parser.add_argument('--workers', type=int, default=8, help="Dataloader worker processes")
+    parser.add_argument('--nice', type=int, help="Lower the training priority by this much")
+    args = parser.parse_args()
+    if args.cores or args.threads or args.nice:
+        from resources import apply_training_budget
+        apply_training_budget(args.cores, args.threads, args.nice)
+    train_model(resize=args.resize, incremental=args.incremental, replay=args.replay,
+                cache=None if args.cache == 'none' else args.cache, archive=args.archive, workers=args.workers)
@@ -1,146 +1,501 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
-import json
 import os
 import time
+import threading
+import contextlib
+import collections
+import shutil
+import yaml
+from ripeness import RipenessEngine
+from sample_writer import move_samples
+from store import FruitStore, file_hash
+from sample_archive import SampleArchive
+from fewshot import FewShotRegistry
+from nutrition import NutritionCatalog
+from backends import load_model
+from train import TRAIN_IMGSZ
+from metrics import metrics
+
+class StartupReport:
+    """Collects how long each startup phase took (import, weights, warmup, camera open...)."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.phases[name] = seconds
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self.phases
+
+    def mark(self, name):
+        # Time since the process started using this module
+        self.record(name, time.perf_counter() - self.start)
+
+    def summary(self):
+        with self._lock:
+            lines = [f"  {name:12s} {seconds * 1000:8.0f} ms" for name, seconds in self.phases.items()]
+        return "Startup times:\n" + "\n".join(lines)
+
+
+startup_report = StartupReport()
+
+# Default YOLO (COCO) classes we treat as fruit
+DEFAULT_FRUITS = ('apple', 'orange', 'banana', 'broccoli', 'carrot')
+
+
+def _to_numpy(x):
+    # Works for torch tensors (CPU or GPU) and for plain arrays
+    if hasattr(x, 'cpu'):
+        x = x.cpu().numpy()
+    return np.asarray(x)
+
+
+class Detections:
+    """
+    Array-backed detections for one frame (struct of arrays).
+
+    xyxy (N, 4) int32, cls (N,) int32, conf (N,) float32, ids (N,) int32
+    (-1 when the tracker has not assigned an id yet) and is_fruit (N,) bool.
+
+    Iterating or indexing yields the same dicts detect_and_track always
+    returned ('bbox', 'name', 'conf', 'is_fruit', plus 'id'), built on demand,
+    so the GUIs keep working unchanged.
+    """
+    __slots__ = ('xyxy', 'cls', 'conf', 'ids', 'is_fruit', 'names')
+
+    def __init__(self, xyxy, cls, conf, ids, is_fruit, names):
+        self.xyxy = xyxy
+        self.cls = cls
+        self.conf = conf
+        self.ids = ids
+        self.is_fruit = is_fruit
+        self.names = names
+
+    @classmethod
+    def empty(cls, names):
+        return cls(np.zeros((0, 4), np.int32), np.zeros(0, np.int32), np.zeros(0, np.float32),
+                   np.zeros(0, np.int32), np.zeros(0, bool), names)
+
+    def __len__(self):
+        return len(self.cls)
+
+    def __bool__(self):
+        return len(self.cls) > 0
+
+    def __getitem__(self, i):
+        x1, y1, x2, y2 = self.xyxy[i].tolist()
+        track_id = int(self.ids[i])
+        return {
+            'bbox': (x1, y1, x2, y2),
+            'name': self.names[int(self.cls[i])],
+            'conf': float(self.conf[i]),
+            'is_fruit': bool(self.is_fruit[i]),
+            'id': track_id if track_id >= 0 else None
+        }
+
+    def __iter__(self):
+        for i in range(len(self.cls)):
+            yield self[i]
+
+    def fruits(self):
+        # Subset containing only fruit detections
+        return self.select(self.is_fruit)
+
+    def select(self, mask):
+        return Detections(self.xyxy[mask], self.cls[mask], self.conf[mask],
+                          self.ids[mask], self.is_fruit[mask], self.names)
+
 
 class Detector:
-    def __init__(self, model_path='yolov8n.pt'):
-        # Prefer custom trained model if it exists
-        if os.path.exists('best.pt'):
-            print("Loading custom model: best.pt")
-            self.model = YOLO('best.pt')
+    def __init__(self, model_path='yolov8n.pt', model=None, backend=None, int8=None, load_async=False, fewshot=False):
+        # Inference backend: pytorch (default), onnx or openvino, see backends.py.
+        # Can also be picked per machine with FRUIT_BACKEND / FRUIT_INT8=1
+        # fewshot=True (the GUIs) adds the few-shot registry and its embedder, see _init_catalogs
+        self._init_state(backend or os.environ.get('FRUIT_BACKEND', 'pytorch'),
+                         int8 if int8 is not None else os.environ.get('FRUIT_INT8') == '1', fewshot)
+
+        # An already built model (e.g. the benchmark stub) can be passed in directly
+        if model is not None:
+            self.model = model
+            self.ready.set()
+        elif load_async:
+            # The GUIs show their window right away and the model arrives a bit later
+            threading.Thread(target=self._load_initial_model, args=(model_path,), name="model-loader", daemon=True).start()
         else:
-            print(f"Loading fast-track base model: {model_path}")
-            self.model = YOLO(model_path)
-            
-        self.db_path = 'database.json'
+            # Batch jobs and benchmarks must fail on bad weights, not run on empty detections
+            self._load_initial_model(model_path, reraise=True)
+
+    def _init_state(self, backend, int8=False, fewshot=False):
+        # Everything but the model itself, shared with RemoteDetector
+        self.backend = backend
+        self.int8 = int8
+        # Same input size as training (exported models are built for this size too)
+        self.imgsz = TRAIN_IMGSZ
+
+        # One ByteTrack state per stream for the multi-stream API
+        self._stream_trackers = {}
+        self.tracker_cfg = 'bytetrack.yaml'
+
+        # Class-id -> is_fruit lookup, see _get_fruit_lut
+        self._fruit_lut = None
+        self._fruit_lut_key = None
+
+        self._init_catalogs(fewshot)
+
+        self._model_lock = threading.Lock()
+        self._recent_frames = collections.deque(maxlen=3)
+
+        # Set once the model is loaded and warmed up; until then detect_and_track returns nothing
+        self.ready = threading.Event()
+        self.load_error = None
+        self.model = None
+        # Bumped by every successful hot swap: track ids start over even if the classes stay the same
+        self.model_version = 0
+
+    def _init_catalogs(self, fewshot=False):
+        # Everything besides the model: fruit db, nutrition, ripeness thresholds
+        self.db_path = 'fruits.db'
+        self.legacy_db_path = 'database.json'  # Imported once into fruits.db
         self.nutrition_path = 'nutrition_data.json'
+        self.ripeness_path = 'ripeness_table.json'
         self.load_db()
         self.load_nutrition()
-        
+        self.ripeness = RipenessEngine.load(self.ripeness_path)
+        # Optional sharded archive for captured samples instead of data/<fruit>/*.jpg
+        archive_dir = os.environ.get('FRUIT_SAMPLE_ARCHIVE')
+        self.sample_archive = SampleArchive(archive_dir) if archive_dir else None
+        # Embeddings of saved crops: new fruits are recognised right after Save, before any retrain.
+        # Only for the GUIs: the embedder is torch + MobileNet, batch workers and the server don't need it
+        self.registry = FewShotRegistry(preload=True) if fewshot else None
+
+    def _load_initial_model(self, model_path, reraise=False):
+        try:
+            with startup_report.measure('import'):
+                import ultralytics  # noqa: F401 (heavy: pulls in torch)
+            # Prefer custom trained model if it exists
+            if os.path.exists('best.pt'):
+                print(f"Loading custom model: best.pt ({self.backend})")
+                model_path = 'best.pt'
+            else:
+                print(f"Loading fast-track base model: {model_path} ({self.backend})")
+            with startup_report.measure('weights'):
+                self.model = self._load_model(model_path)
+            with startup_report.measure('warmup'):
+                self.warmup()
+            if model_path == 'best.pt' and not os.path.exists(self._last_good_path(model_path)):
+                # Starting point for rolling back a bad retrain
+                shutil.copy(model_path, self._last_good_path(model_path))
+            self.ready.set()
+        except Exception as e:
+            self.load_error = e
+            print(f"Error loading model: {e}")
+            if reraise:
+                raise
+
+    def warmup(self, model=None):
+        # First inference allocates everything, do it on a blank frame instead of the first camera frame
+        model = model or self.model
+        model.predict(np.zeros((self.imgsz, self.imgsz, 3), np.uint8), imgsz=self.imgsz, verbose=False)
+
+    def _load_model(self, weights):
+        return load_model(weights, self.backend, self.int8, self.imgsz)
+
     def load_db(self):
-        if os.path.exists(self.db_path):
-            with open(self.db_path, 'r') as f:
-                self.db = json.load(f)
-        else:
-            self.db = {}
+        # Behaves like the old dict (name -> record), case-insensitive and shared safely between processes
+        self.db = FruitStore(self.db_path, json_path=self.legacy_db_path)
 
     def load_nutrition(self):
-        if os.path.exists(self.nutrition_path):
-            with open(self.nutrition_path, 'r') as f:
-                self.nutrition = json.load(f)
-        else:
-            self.nutrition = {}
+        # Indexed once into nutrition.db and memory-mapped, nothing is parsed up front
+        self.nutrition = NutritionCatalog(self.nutrition_path)
 
     def save_db(self):
-        with open(self.db_path, 'w') as f:
-            json.dump(self.db, f, indent=4)
+        # Every FruitStore write is already committed atomically, nothing left to flush
+        pass
 
     def detect_and_track(self, frame):
+        if not self.ready.is_set():
+            return Detections.empty({})
+
+        # Kept for warming up / checking a new model on real frames, see reload_model
+        self._recent_frames.append(frame)
+        # The lock only guards against a model swap landing in the middle of a frame
+        with self._model_lock:
+            with metrics.timer('inference'):
+                results = self._track(self.model, frame)
+            with metrics.timer('postprocess'):
+                return self._parse_result(results[0])
+
+    def _track(self, model, frame):
         # Using ByteTrack for better persistence during flips/rotations
         # Agnostic NMS helps prevent overlapping boxes for the same object seen as different classes
-        results = self.model.track(
+        return model.track(
             frame, 
             persist=True, 
             verbose=False, 
+            imgsz=self.imgsz,
             conf=0.25, 
             iou=0.5, 
-            tracker="bytetrack.yaml",
+            tracker=self.tracker_cfg,
             agnostic_nms=True
         )
-        detections = []
-        
-        if results[0].boxes:
-            for box in results[0].boxes:
-                # Box coordinates
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                
-                # Class and confidence
-                cls_id = int(box.cls[0])
-                name = self.model.names[cls_id]
-                conf = float(box.conf[0])
-                
-                # Check if this object is a fruit (default yolo coco classes)
-                fruits = ['apple', 'orange', 'banana', 'broccoli', 'carrot']
-                
-                is_fruit = name in fruits or name in self.db
-                
-                detections.append({
-                    'bbox': (x1, y1, x2, y2),
-                    'name': name,
-                    'conf': conf,
-                    'is_fruit': is_fruit
-                })
-                
-        return detections
+
+    def detect_and_track_streams(self, frames):
+        """
+        Multi-stream variant of detect_and_track.
+        `frames` maps a stream id (camera index, file name, ...) to that stream's
+        current frame. All frames go through ONE batched predict call and each
+        stream is then updated with its own ByteTrack state.
+        Returns {stream_id: detections}.
+        """
+        stream_ids = list(frames)
+        if not stream_ids:
+            return {}
+        if not self.ready.is_set():
+            return {sid: Detections.empty({}) for sid in stream_ids}
+        # Lets reload_model check a new model on real frames, like detect_and_track does
+        self._recent_frames.append(frames[stream_ids[-1]])
+
+        with self._model_lock, metrics.timer('inference_batch'):
+            results = self.model.predict(
+                [frames[sid] for sid in stream_ids],
+                verbose=False,
+                imgsz=self.imgsz,
+                conf=0.25,
+                iou=0.5,
+                agnostic_nms=True
+            )
+            return {
+                sid: self._parse_result(self._track_stream(sid, result))
+                for sid, result in zip(stream_ids, results)
+            }
+
+    def reset_stream(self, stream_id=None):
+        # Forget tracker state for one stream (e.g. camera unplugged) or for all of them
+        if stream_id is None:
+            self._stream_trackers.clear()
+        else:
+            self._stream_trackers.pop(stream_id, None)
+
+    def _new_tracker(self):
+        from ultralytics.trackers.byte_tracker import BYTETracker
+        from ultralytics.utils import IterableSimpleNamespace
+        from ultralytics.utils.checks import check_yaml
+
+        with open(check_yaml(self.tracker_cfg), 'r') as f:
+            cfg = IterableSimpleNamespace(**yaml.safe_load(f))
+        return BYTETracker(args=cfg)
+
+    def _track_stream(self, stream_id, result):
+        # Same steps ultralytics runs in its track callback, but with a tracker per stream
+        import torch
+
+        tracker = self._stream_trackers.get(stream_id)
+        if tracker is None:
+            tracker = self._stream_trackers[stream_id] = self._new_tracker()
+
+        tracks = tracker.update(result.boxes.cpu().numpy(), result.orig_img)
+        if len(tracks) == 0:
+            return result[:0]
+
+        # tracks columns: x1, y1, x2, y2, track_id, conf, cls, det_index
+        result = result[tracks[:, -1].astype(int)]
+        result.update(boxes=torch.as_tensor(tracks[:, :-1]))
+        return result
+
+    def _parse_result(self, result):
+        boxes = result.boxes
+        if not boxes:
+            return Detections.empty(self.model.names)
+
+        # Pull everything off the tensors in one go instead of once per box
+        xyxy = _to_numpy(boxes.xyxy).astype(np.int32)
+        cls = _to_numpy(boxes.cls).astype(np.int32)
+        conf = _to_numpy(boxes.conf).astype(np.float32)
+        ids = _to_numpy(boxes.id).astype(np.int32) if boxes.id is not None else np.full(len(cls), -1, np.int32)
+
+        is_fruit = self._get_fruit_lut()[cls]
+        return Detections(xyxy, cls, conf, ids, is_fruit, self.model.names)
+
+    def _get_fruit_lut(self):
+        # Boolean lookup indexed by class id, rebuilt only when the model or the db changes
+        key = (id(self.model), self.db.version())
+        if self._fruit_lut is None or self._fruit_lut_key != key:
+            names = self.model.names
+            if isinstance(names, dict):
+                items = names.items()
+                size = max(names) + 1 if names else 0
+            else:
+                items = enumerate(names)
+                size = len(names)
+            lut = np.zeros(size, dtype=bool)
+            for cls_id, name in items:
+                # Check if this object is a fruit (default yolo coco classes) or one we trained
+                lut[cls_id] = name in DEFAULT_FRUITS or name in self.db
+            self._fruit_lut = lut
+            self._fruit_lut_key = key
+        return self._fruit_lut
 
     def get_ripeness_color(self, fruit_crop, fruit_type):
         if fruit_crop.size == 0:
             return "Unknown"
-            
-        hsv = cv2.cvtColor(fruit_crop, cv2.COLOR_BGR2HSV)
-        
-        # Simple color-based logic for common fruits
-        if fruit_type == 'apple':
-            # Red/Green analysis
-            red_lower = np.array([0, 100, 100])
-            red_upper = np.array([10, 255, 255])
-            green_lower = np.array([35, 100, 100])
-            green_upper = np.array([85, 255, 255])
-            
-            red_mask = cv2.inRange(hsv, red_lower, red_upper)
-            green_mask = cv2.inRange(hsv, green_lower, green_upper)
-            
-            red_ratio = np.sum(red_mask > 0) / fruit_crop.size
-            green_ratio = np.sum(green_mask > 0) / fruit_crop.size
-            
-            if red_ratio > 0.05: return "Ripe (Red)"
-            if green_ratio > 0.05: return "Underripe (Green)"
-            return "Perfectly Ripe"
-
-        elif fruit_type == 'banana':
-            yellow_lower = np.array([20, 100, 100])
-            yellow_upper = np.array([30, 255, 255])
-            yellow_mask = cv2.inRange(hsv, yellow_lower, yellow_upper)
-            yellow_ratio = np.sum(yellow_mask > 0) / fruit_crop.size
-            
-            if yellow_ratio > 0.05: return "Perfectly Ripe"
-            return "Underripe"
-            
-        elif fruit_type == 'orange':
-            orange_lower = np.array([10, 100, 100])
-            orange_upper = np.array([25, 255, 255])
-            orange_mask = cv2.inRange(hsv, orange_lower, orange_upper)
-            orange_ratio = np.sum(orange_mask > 0) / fruit_crop.size
-            if orange_ratio > 0.1: return "Perfectly Ripe"
-            return "Underripe"
-
-        return "Unknown"
-
-    def save_fruit_data(self, fruit_name, condition, samples):
-        # In a real app, we might train a model, here we just record the manual entry
-        self.db[fruit_name.lower()] = {
-            'condition': condition,
-            'samples_count': len(samples),
-            'last_updated': time.ctime()
-        }
-        self.save_db()
-        
+        h, w = fruit_crop.shape[:2]
+        with metrics.timer('ripeness'):
+            return self.ripeness.evaluate(fruit_crop, [(0, 0, w, h)], [fruit_type])[0]
+
+    def get_ripeness_batch(self, frame, detections):
+        # Ripeness for every detection of the frame in a single pass
+        names = [detections.names[int(c)] for c in detections.cls]
+        with metrics.timer('ripeness'):
+            return self.ripeness.evaluate(frame, detections.xyxy, names)
+
+    def save_fruit_data(self, fruit_name, condition, samples, block=False):
+        # block=True also waits for the few-shot enrolment (benchmarks), the GUIs let it run in the background
+        if self.sample_archive is not None:
+            # Appended to the current shard, staged files are copied byte for byte (no re-encode)
+            with metrics.timer('disk_write'):
+                rows = self.sample_archive.add(fruit_name, samples)
+            for path in samples:
+                if isinstance(path, str):
+                    os.remove(path)
+            with metrics.timer('db_write'):
+                self.db.save_fruit(fruit_name, condition, rows)
+            self.enroll_samples(fruit_name, condition, [row[0] for row in rows], block)
+            return
+
+        # Samples already written by a SampleWriter are just moved into the data folder
+        paths = move_samples([s for s in samples if isinstance(s, str)], f'data/{fruit_name}')
+
         # Save images to data folder
         os.makedirs(f'data/{fruit_name}', exist_ok=True)
         for i, img in enumerate(samples):
+            if isinstance(img, str):
+                continue
             # Save using a unique timestamp to avoid overwriting previous sessions
             ts = int(time.time() * 1000)
-            cv2.imwrite(f'data/{fruit_name}/sample_{ts}_{i}.jpg', img)
+            path = f'data/{fruit_name}/sample_{ts}_{i}.jpg'
+            with metrics.timer('disk_write'):
+                ok = cv2.imwrite(path, img)
+            if ok:
+                paths.append(path)
+
+        # In a real app, we might train a model, here we just record the manual entry
+        # (fruit + sample catalog in one transaction)
+        with metrics.timer('db_write'):
+            rows = [(path.replace(os.sep, '/'), file_hash(path), os.path.getmtime(path)) for path in paths]
+            self.db.save_fruit(fruit_name, condition, rows)
+        self.enroll_samples(fruit_name, condition, paths, block)
 
-    def reload_model(self):
-        if os.path.exists('best.pt'):
-            self.model = YOLO('best.pt')
-            print("Model reloaded from best.pt")
+    def enroll_samples(self, fruit_name, condition, paths, block=False):
+        """Adds saved samples (files or archive refs) to the few-shot registry, in the background by default."""
+        if self.registry is None:
+            return
+        if not block:
+            threading.Thread(target=self.enroll_samples, args=(fruit_name, condition, paths, True),
+                             name="fewshot-enroll", daemon=True).start()
+            return
+        if self.sample_archive is not None:
+            crops = [self.sample_archive.read(p) for p in paths]
         else:
-            print("best.pt not found, keeping current model.")
+            crops = [cv2.imread(p) for p in paths]
+        try:
+            self.registry.enroll(fruit_name, condition, crops)
+        except Exception as e:
+            print(f"Few-shot enrolment failed: {e}")
+
+    def classify_boxes(self, frame, boxes, is_fruit=None):
+        """
+        Few-shot match per xyxy box: (fruit, condition, score), or None if nothing
+        enrolled is close. Boxes the detector doesn't call fruit (is_fruit[i] False)
+        need a much closer match before they are taken for an enrolled fruit.
+        """
+        if self.registry is None or not len(self.registry) or not len(boxes):
+            return [None] * len(boxes)
+        h, w = frame.shape[:2]
+        crops = [frame[max(int(y1), 0):min(int(y2), h), max(int(x1), 0):min(int(x2), w)] for x1, y1, x2, y2 in boxes]
+        valid = [i for i, crop in enumerate(crops) if crop.size]
+        results = [None] * len(boxes)
+        with metrics.timer('fewshot'):
+            strict = None if is_fruit is None else [not is_fruit[i] for i in valid]
+            for i, match in zip(valid, self.registry.classify([crops[i] for i in valid], strict)):
+                results[i] = match
+        return results
+
+    def reload_model(self, weights='best.pt', block=True, on_done=None):
+        """
+        Hot-swaps the model without stalling live inference.
+
+        The new weights are loaded, warmed up and checked on the last live frames
+        while the current model keeps serving; the swap itself happens between two
+        frames. A model that fails to load or to run is rejected, and weights is
+        restored from the last good copy. Returns True/False when block=True,
+        otherwise runs in the background and calls on_done(ok) at the end.
+        """
+        if not block:
+            threading.Thread(target=self.reload_model, args=(weights, True, on_done), name="model-swap", daemon=True).start()
+            return None
+
+        if not os.path.exists(weights):
+            print(f"{weights} not found, keeping current model.")
+            ok = False
+        else:
+            ok = self._swap_model(weights)
+        if on_done:
+            on_done(ok)
+        return ok
+
+    def _swap_model(self, weights):
+        last_good = self._last_good_path(weights)
+        try:
+            # Exported backends are re-exported here automatically if the weights changed
+            candidate = self._load_model(weights)
+            self.warmup(candidate)
+            # Run the new model on the latest real frames: checks it works, and
+            # gives its tracker a few frames of history so track ids settle fast
+            for frame in list(self._recent_frames):
+                boxes = self._track(candidate, frame)[0].boxes
+                if boxes is not None and len(boxes) and not np.isfinite(_to_numpy(boxes.xyxy)).all():
+                    raise ValueError("model produced invalid boxes")
+            if not candidate.names:
+                raise ValueError("model has no class names")
+        except Exception as e:
+            print(f"Rejected new model from {weights}: {e}")
+            if os.path.exists(last_good):
+                shutil.copy(last_good, weights)
+                print(f"Restored {weights} from {last_good}")
+            return False
+
+        with self._model_lock:
+            self.model = candidate
+            # Class ids may mean something else now, start the per-stream trackers over
+            self._stream_trackers.clear()
+            self.model_version += 1
+        self.ready.set()
+        shutil.copy(weights, last_good)
+        print(f"Model reloaded from {weights}")
+        return True
+
+    def close(self):
+        # Nothing to release for an in-process model, RemoteDetector disconnects from the server here
+        pass
+
+    @staticmethod
+    def _last_good_path(weights):
+        root, ext = os.path.splitext(weights)
+        return f'{root}.last_good{ext}'
 
     def get_nutrition(self, fruit_name):
-        return self.nutrition.get(fruit_name.lower(), None)
+        # Exact name, synonym, singular or closest spelling; resolved names are cached
+        return self.nutrition.get(fruit_name)